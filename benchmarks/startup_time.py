@@ -0,0 +1,129 @@
+"""
+Measures how long importing the trigger modules takes in a fresh interpreter
+and fails if any import exceeds the budget.
+
+Run from the repo root:
+    python benchmarks/startup_time.py --budget 2 --files 200000
+
+`--files` runs the imports from a scratch directory holding that many files,
+as a trigger does when the server starts it inside a large depot directory,
+so any startup cost that grows with the working directory shows up here.
+`--importtime` also lists the slowest imports reported by `python -X importtime`.
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+SRC_PATH = Path(__file__).resolve().parent.parent / "src"
+
+MODULES = ("tagging_ai", "main", "uasset_trigger")
+
+
+def populate(directory, file_count, files_per_directory=1000):
+    for index in range(file_count):
+        subdirectory = Path(directory) / f"dir_{index // files_per_directory}"
+        subdirectory.mkdir(exist_ok=True)
+        (subdirectory / f"file_{index}.txt").touch()
+
+
+def run_import(module, cwd, *options):
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(
+        [str(SRC_PATH), str(SRC_PATH.parent), environment.get("PYTHONPATH", "")]
+    )
+    return subprocess.run(
+        [sys.executable, *options, "-c", f"import {module}"],
+        cwd=cwd,
+        env=environment,
+        check=True,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+
+def time_import(module, cwd):
+    start = time.perf_counter()
+    run_import(module, cwd)
+    return time.perf_counter() - start
+
+
+def import_times(module, cwd):
+    """
+    Returns [(cumulative microseconds, imported module)] from
+    `python -X importtime`, slowest first.
+    """
+    times = []
+    for line in run_import(module, cwd, "-X", "importtime").stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times.append((int(cumulative), name.strip()))
+    return sorted(times, reverse=True)
+
+
+def run(modules, budget, repeat, cwd, importtime=0):
+    over_budget = []
+    for module in modules:
+        timings = [time_import(module, cwd) for _ in range(repeat)]
+        median = statistics.median(timings)
+        logger.info(
+            f"import {module}: median {median:.3f}s, max {max(timings):.3f}s over {repeat} runs"
+        )
+        if median > budget:
+            over_budget.append(module)
+
+        if importtime:
+            for cumulative, name in import_times(module, cwd)[:importtime]:
+                logger.info(f"    {cumulative / 1000:8.1f}ms  {name}")
+
+    if over_budget:
+        logger.error(f"Over the {budget}s startup budget: {', '.join(over_budget)}")
+        return 1
+    logger.info(f"All imports within the {budget}s startup budget")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--budget", type=float, default=2.0, help="seconds allowed per import")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--files",
+        type=int,
+        default=0,
+        help="run from a scratch directory containing this many files",
+    )
+    parser.add_argument(
+        "--importtime",
+        type=int,
+        nargs="?",
+        const=15,
+        default=0,
+        help="list this many of the slowest imports from python -X importtime",
+    )
+
+    parsed_args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        if parsed_args.files:
+            populate(scratch_dir, parsed_args.files)
+        sys.exit(
+            run(
+                parsed_args.modules,
+                parsed_args.budget,
+                parsed_args.repeat,
+                scratch_dir,
+                parsed_args.importtime,
+            )
+        )
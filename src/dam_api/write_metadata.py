@@ -2,119 +2,393 @@
 from __future__ import print_function
 
 import os
+import json
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 SERVER_ADDRESS = os.environ.get('DAM_SERVER_ADDRESS')
 ACCOUNT_KEY = os.environ.get('DAM_ACCOUNT_KEY')
 
+# Optional file shared by trigger processes so they don't all refetch the templates.
+TEMPLATE_CACHE_PATH = os.environ.get('DAM_TEMPLATE_CACHE_PATH')
+TEMPLATE_CACHE_TTL = float(os.environ.get('DAM_TEMPLATE_CACHE_TTL', 600))
 
-def get_or_create_metadata_field(field_name):
-    metadata_field_url = "{}/api/company/file_attribute_templates".format(SERVER_ADDRESS)
-    
-    all_metadata_params = {
-        'account_key': ACCOUNT_KEY,
-    }
-        
-    all_metadata_response = requests.get(
-        metadata_field_url, 
-        params=all_metadata_params,
-    )
-
-    if all_metadata_response.status_code > 299:
-        print('request failed')
+MAX_PATHS_PER_REQUEST = int(os.environ.get('DAM_MAX_PATHS_PER_REQUEST', 500))
+
+# Longest time a streaming BatchWriter holds on to writes before sending them.
+FLUSH_INTERVAL = float(os.environ.get('DAM_FLUSH_INTERVAL', 5))
+
+POOL_SIZE = int(os.environ.get('DAM_POOL_SIZE', 10))
+CONNECT_TIMEOUT = float(os.environ.get('DAM_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('DAM_READ_TIMEOUT', 60))
+MAX_RETRIES = int(os.environ.get('DAM_MAX_RETRIES', 5))
+RETRY_BACKOFF = float(os.environ.get('DAM_RETRY_BACKOFF', 0.5))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def load_template_cache():
+    if not TEMPLATE_CACHE_PATH:
+        return {}
+
+    try:
+        with open(TEMPLATE_CACHE_PATH, 'r') as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+    if time.time() - cache.get('fetched_at', 0) > TEMPLATE_CACHE_TTL:
+        return {}
+
+    return cache.get('fields', {})
+
+
+def save_template_cache(fields):
+    if not TEMPLATE_CACHE_PATH:
         return
-    
-    all_metadata = all_metadata_response.json()
-    
-    image_description_field = [_ for _ in all_metadata['results'] if _['name'] == field_name]
-
-    if image_description_field:
-        image_description_field = image_description_field[0]
-    else:
+
+    temp_path = '{}.{}.tmp'.format(TEMPLATE_CACHE_PATH, os.getpid())
+    try:
+        with open(temp_path, 'w') as cache_file:
+            json.dump({'fetched_at': time.time(), 'fields': fields}, cache_file)
+        os.replace(temp_path, TEMPLATE_CACHE_PATH)
+    except OSError as err:
+        print('could not write template cache: {}'.format(err))
+
+
+def make_path_entry(selected_asset):
+    path_entry = {
+        'path': selected_asset
+    }
+
+    if '@' in selected_asset:
+        asset_path, asset_identifier = selected_asset.split('@')
+        path_entry['path'] = asset_path
+        path_entry['identifier'] = asset_identifier
+
+    return path_entry
+
+
+class DamClient(object):
+    """
+    Helix DAM API client. Requests go through one pooled keep-alive session
+    with connect/read timeouts, and 429/5xx responses on idempotent requests
+    are retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        server_address=SERVER_ADDRESS,
+        account_key=ACCOUNT_KEY,
+        pool_size=POOL_SIZE,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        max_retries=MAX_RETRIES,
+        retry_backoff=RETRY_BACKOFF,
+    ):
+        self.server_address = server_address
+        self.account_key = account_key
+        self.timeout = (connect_timeout, read_timeout)
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=retry_backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['GET', 'PUT']),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # field name -> file attribute template, reloaded after TEMPLATE_CACHE_TTL
+        self.metadata_fields = {}
+        self.metadata_fields_loaded_at = 0.0
+
+        # endpoint -> {'count', 'errors', 'total', 'max'} in seconds
+        self.latencies = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def request(self, method, endpoint, **kwargs):
+        url = "{}{}".format(self.server_address, endpoint)
+        kwargs.setdefault('timeout', self.timeout)
+
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException as err:
+            self.record_latency(method, endpoint, time.perf_counter() - start, True)
+            print('request failed: {}'.format(err))
+            return
+
+        self.record_latency(
+            method, endpoint, time.perf_counter() - start, response.status_code > 299
+        )
+        return response
+
+    def record_latency(self, method, endpoint, elapsed, failed):
+        stats = self.latencies.setdefault(
+            '{} {}'.format(method, endpoint),
+            {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0},
+        )
+        stats['count'] += 1
+        stats['errors'] += int(failed)
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+
+    def latency_stats(self):
+        return {
+            endpoint: {
+                'count': stats['count'],
+                'errors': stats['errors'],
+                'mean': stats['total'] / stats['count'],
+                'max': stats['max'],
+            }
+            for endpoint, stats in self.latencies.items()
+        }
+
+    def reset_latency_stats(self):
+        self.latencies = {}
+
+    def fetch_metadata_fields(self):
+        all_metadata_params = {
+            'account_key': self.account_key,
+        }
+
+        all_metadata_response = self.request(
+            'GET',
+            '/api/company/file_attribute_templates',
+            params=all_metadata_params,
+        )
+
+        if all_metadata_response is None or all_metadata_response.status_code > 299:
+            print('request failed')
+            return
+
+        all_metadata = all_metadata_response.json()
+
+        self.metadata_fields = {_['name']: _ for _ in all_metadata['results']}
+        self.metadata_fields_loaded_at = time.time()
+        save_template_cache(self.metadata_fields)
+
+        return self.metadata_fields
+
+    def create_metadata_field(self, field_name):
         add_metadata_field_params = {
-            'account_key': ACCOUNT_KEY,
+            'account_key': self.account_key,
             "name": field_name,
             "type": "text",
-            "available_values":[],
+            "available_values": [],
             "hidden": False
         }
-        
-        add_metadata_field_response = requests.post(
-            metadata_field_url, 
+
+        add_metadata_field_response = self.request(
+            'POST',
+            '/api/company/file_attribute_templates',
             json=add_metadata_field_params,
         )
 
-        image_description_field = add_metadata_field_response.json()
+        if add_metadata_field_response is None or add_metadata_field_response.status_code > 299:
+            print('request failed')
+            return
 
-    return image_description_field
+        metadata_field = add_metadata_field_response.json()
 
+        self.metadata_fields[field_name] = metadata_field
+        save_template_cache(self.metadata_fields)
 
-def attach_metadata(selected_asset, field_name, value):
+        return metadata_field
 
-    image_description_field = get_or_create_metadata_field(field_name)
+    def get_or_create_metadata_field(self, field_name):
+        if (
+            not self.metadata_fields
+            or time.time() - self.metadata_fields_loaded_at > TEMPLATE_CACHE_TTL
+        ):
+            self.metadata_fields = load_template_cache()
+            self.metadata_fields_loaded_at = time.time()
 
-    add_asset_metadata_url = "{}/api/p4/batch/custom_file_attributes".format(SERVER_ADDRESS)
-    
-    add_asset_metadata_body = {
-        'account_key': ACCOUNT_KEY,
-        'paths':[
-            {
-                'path': selected_asset
-            }
-        ],
-        'create': [
-            {
-                'uuid': image_description_field['uuid'],
-                'value': value
-            }
-        ]
-    }
-        
-    if '@' in selected_asset:
-        asset_path, asset_identifier = selected_asset.split('@')
-        add_asset_metadata_body['paths'][0]['path'] = asset_path
-        add_asset_metadata_body['paths'][0]['identifier'] = asset_identifier
+        if field_name in self.metadata_fields:
+            return self.metadata_fields[field_name]
 
-    add_asset_metadata_response = requests.put(
-        add_asset_metadata_url, 
-        json=add_asset_metadata_body,
-    )
+        # A miss means our copy may be stale, so refetch before creating the field.
+        if self.fetch_metadata_fields() is None:
+            return
 
-    print(add_asset_metadata_response)
-    try:
-        print(add_asset_metadata_response.json())
-    except:
-        print('no metadata json')
+        if field_name in self.metadata_fields:
+            return self.metadata_fields[field_name]
 
-def attach_additional_tags(selected_asset, tags):
-    if not tags:
-        return
-    
-    add_asset_tags_url = "{}/api/p4/batch/tags".format(SERVER_ADDRESS)
-    add_asset_tags_body = {
-        'account_key': ACCOUNT_KEY,
-        'paths':[
-            {
-                'path': selected_asset
-            }
-        ],
-        'create': tags,
+        return self.create_metadata_field(field_name)
 
-    }
-        
-    if '@' in selected_asset:
-        asset_path, asset_identifier = selected_asset.split('@')
-        add_asset_tags_body['paths'][0]['path'] = asset_path
-        add_asset_tags_body['paths'][0]['identifier'] = asset_identifier
+    def attach_metadata(self, selected_asset, field_name, value):
+        self.attach_metadata_batch([selected_asset], field_name, value)
 
-    add_asset_tags_response = requests.put(
-        add_asset_tags_url, 
-        json=add_asset_tags_body,
-    )
+    def attach_metadata_batch(self, selected_assets, field_name, value):
 
-    print(add_asset_tags_response)
-    try:
-        print(add_asset_tags_response.json())
-    except:
-        print('no tags json')
+        image_description_field = self.get_or_create_metadata_field(field_name)
+        if not image_description_field:
+            print('no metadata field {}'.format(field_name))
+            return
+
+        add_asset_metadata_body = {
+            'account_key': self.account_key,
+            'paths': [make_path_entry(_) for _ in selected_assets],
+            'create': [
+                {
+                    'uuid': image_description_field['uuid'],
+                    'value': value
+                }
+            ]
+        }
+
+        add_asset_metadata_response = self.request(
+            'PUT',
+            '/api/p4/batch/custom_file_attributes',
+            json=add_asset_metadata_body,
+        )
+
+        print(add_asset_metadata_response)
+        try:
+            print(add_asset_metadata_response.json())
+        except:
+            print('no metadata json')
+
+    def attach_additional_tags(self, selected_asset, tags):
+        self.attach_tags_batch([selected_asset], tags)
+
+    def attach_tags_batch(self, selected_assets, tags):
+        if not tags:
+            return
+
+        add_asset_tags_body = {
+            'account_key': self.account_key,
+            'paths': [make_path_entry(_) for _ in selected_assets],
+            'create': tags,
+
+        }
+
+        add_asset_tags_response = self.request(
+            'PUT',
+            '/api/p4/batch/tags',
+            json=add_asset_tags_body,
+        )
+
+        print(add_asset_tags_response)
+        try:
+            print(add_asset_tags_response.json())
+        except:
+            print('no tags json')
+
+
+_client = None
+
+
+def get_client():
+    """
+    Returns the DamClient shared by every changelist this process handles,
+    creating it on first use. Keeping it keeps its pooled connections and
+    metadata field templates warm in the resident worker service.
+    """
+    global _client
+    if _client is None:
+        _client = DamClient()
+    return _client
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class BatchWriter(object):
+    """
+    Collects metadata and tag writes for a whole changelist and sends them as
+    a few batch requests instead of one request per asset.
+    """
+
+    def __init__(
+        self,
+        client,
+        max_paths_per_request=MAX_PATHS_PER_REQUEST,
+        flush_interval=FLUSH_INTERVAL,
+    ):
+        self.client = client
+        self.max_paths_per_request = max_paths_per_request
+        self.flush_interval = flush_interval
+        self.metadata = {}  # (field name, value) -> [asset, ...]
+        self.tags = {}  # asset -> [tag, ...]
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def add_metadata(self, selected_asset, field_name, value):
+        self.metadata.setdefault((field_name, value), []).append(selected_asset)
+        self.pending += 1
+
+    def add_tags(self, selected_asset, tags):
+        if tags:
+            self.tags.setdefault(selected_asset, []).extend(tags)
+            self.pending += 1
+
+    def flush_if_due(self):
+        """
+        Used when results are streamed in: sends what has been collected once
+        a full request's worth is waiting or `flush_interval` has passed.
+        """
+        if not self.pending:
+            return
+        if (
+            self.pending >= self.max_paths_per_request
+            or time.monotonic() - self.last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def tag_groups(self):
+        """
+        Groups the collected tags into (tags, assets) requests. Tags can be
+        sent either once per distinct tag set or once per distinct tag, and
+        whichever needs fewer requests for this changelist is used.
+        """
+        by_tag_set = {}
+        by_tag = {}
+        for selected_asset, tags in self.tags.items():
+            tags = list(dict.fromkeys(tags))
+            by_tag_set.setdefault(tuple(tags), []).append(selected_asset)
+            for tag in tags:
+                by_tag.setdefault(tag, []).append(selected_asset)
+
+        def request_count(groups):
+            return sum(-(-len(assets) // self.max_paths_per_request) for assets in groups.values())
+
+        if request_count(by_tag) < request_count(by_tag_set):
+            return [([tag], assets) for tag, assets in by_tag.items()]
+        return [(list(tags), assets) for tags, assets in by_tag_set.items()]
+
+    def flush(self):
+        for (field_name, value), selected_assets in self.metadata.items():
+            for chunk in chunked(selected_assets, self.max_paths_per_request):
+                self.client.attach_metadata_batch(chunk, field_name, value)
+
+        for tags, selected_assets in self.tag_groups():
+            for chunk in chunked(selected_assets, self.max_paths_per_request):
+                self.client.attach_tags_batch(chunk, tags)
+
+        self.metadata = {}
+        self.tags = {}
+        self.pending = 0
+        self.last_flush = time.monotonic()
@@ -0,0 +1,274 @@
+import logging
+import os
+import sqlite3
+import time
+
+import sqlite_store
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+DEFAULT_QUEUE_PATH = sqlite_store.DEFAULT_DIRECTORY / "job_queue.sqlite3"
+
+QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH", str(DEFAULT_QUEUE_PATH))
+MAX_ATTEMPTS = int(os.environ.get("JOB_QUEUE_MAX_ATTEMPTS", 3))
+RETRY_DELAY = float(os.environ.get("JOB_QUEUE_RETRY_DELAY", 60))
+KEEP_DAYS = float(os.environ.get("JOB_QUEUE_KEEP_DAYS", 7))
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class DeferJob(Exception):
+    """
+    Raised by a trigger to have its job run again at `run_after` without
+    counting the attempt as a failure.
+    """
+
+    def __init__(self, run_after, reason=""):
+        super().__init__(f"Deferred until {time.ctime(run_after)} {reason}".strip())
+        self.run_after = run_after
+
+
+class JobQueue(sqlite_store.SqliteStore):
+    """
+    Durable queue of trigger jobs shared by every process on the server.
+    Jobs are claimed highest priority first, then oldest first. A changelist
+    that is already pending or running for the same trigger isn't queued
+    twice. Failed jobs are retried with a doubling delay up to
+    `max_attempts` times.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            trigger TEXT NOT NULL,
+            changelist INTEGER NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after REAL NOT NULL,
+            created REAL NOT NULL,
+            started REAL,
+            finished REAL,
+            worker TEXT,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_ready
+            ON jobs (status, priority DESC, id);
+        CREATE UNIQUE INDEX IF NOT EXISTS jobs_active
+            ON jobs (trigger, changelist) WHERE status IN ('pending', 'running');
+    """
+    # Autocommit, so claims can take the write lock with BEGIN IMMEDIATE
+    # before reading and no two workers get the same job.
+    CONNECT_OPTIONS = {"isolation_level": None}
+
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+        super().__init__(path)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    def prepare(self, connection):
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        super().prepare(connection)
+
+    def _transaction(self, statements):
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self.connection)
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+        return result
+
+    def enqueue(self, trigger, changelist, priority=0, run_after=None):
+        """
+        Queues a job and returns its id. If the changelist is already pending
+        or running for this trigger, returns None and keeps the existing job,
+        raising its priority if the new request is more urgent.
+        """
+        now = time.time()
+
+        def insert(connection):
+            existing = connection.execute(
+                "SELECT id FROM jobs WHERE trigger = ? AND changelist = ? AND status IN (?, ?)",
+                (trigger, changelist, PENDING, RUNNING),
+            ).fetchone()
+            if existing:
+                connection.execute(
+                    "UPDATE jobs SET priority = MAX(priority, ?) WHERE id = ?",
+                    (priority, existing["id"]),
+                )
+                return None
+            return connection.execute(
+                """
+                INSERT INTO jobs (trigger, changelist, priority, status, run_after, created)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (trigger, changelist, priority, PENDING, run_after or now, now),
+            ).lastrowid
+
+        job_id = self._transaction(insert)
+        if job_id is None:
+            logger.info(f"{trigger} changelist {changelist} is already queued")
+        return job_id
+
+    def withdraw(self, job_id):
+        """
+        Deletes a job that no worker has claimed yet. Returns False if it has
+        already been claimed.
+        """
+        return bool(
+            self._transaction(
+                lambda connection: connection.execute(
+                    "DELETE FROM jobs WHERE id = ? AND status = ? AND attempts = 0",
+                    (job_id, PENDING),
+                ).rowcount
+            )
+        )
+
+    def claim(self, worker):
+        """
+        Marks the next ready job as running and returns it as a dict, or
+        returns None if nothing is ready.
+        """
+        now = time.time()
+
+        def take(connection):
+            row = connection.execute(
+                """
+                SELECT * FROM jobs WHERE status = ? AND run_after <= ?
+                ORDER BY priority DESC, id LIMIT 1
+                """,
+                (PENDING, now),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                """
+                UPDATE jobs SET status = ?, attempts = attempts + 1, started = ?, worker = ?
+                WHERE id = ?
+                """,
+                (RUNNING, now, worker, row["id"]),
+            )
+            job = dict(row)
+            job["attempts"] += 1
+            return job
+
+        return self._transaction(take)
+
+    def complete(self, job_id):
+        self._transaction(
+            lambda connection: connection.execute(
+                "UPDATE jobs SET status = ?, finished = ?, error = NULL WHERE id = ?",
+                (DONE, time.time(), job_id),
+            )
+        )
+
+    def _record_failure(self, connection, job_id, attempts, error, now):
+        if attempts < self.max_attempts:
+            connection.execute(
+                "UPDATE jobs SET status = ?, run_after = ?, error = ? WHERE id = ?",
+                (PENDING, now + self.retry_delay * 2 ** (attempts - 1), error, job_id),
+            )
+        else:
+            connection.execute(
+                "UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ?",
+                (FAILED, now, error, job_id),
+            )
+            logger.error(f"Job {job_id} failed after {attempts} attempts, giving up")
+
+    def fail(self, job_id, error):
+        """
+        Records a failed attempt, requeueing the job after a backoff delay
+        until it runs out of attempts.
+        """
+        now = time.time()
+
+        def record(connection):
+            attempts = connection.execute(
+                "SELECT attempts FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()["attempts"]
+            self._record_failure(connection, job_id, attempts, error, now)
+
+        self._transaction(record)
+
+    def defer(self, job_id, run_after):
+        """
+        Puts a running job back in the queue until `run_after` without
+        counting the attempt as a failure.
+        """
+        self._transaction(
+            lambda connection: connection.execute(
+                """
+                UPDATE jobs SET status = ?, attempts = attempts - 1, run_after = ?
+                WHERE id = ?
+                """,
+                (PENDING, run_after, job_id),
+            )
+        )
+
+    def abandon(self, error, worker=None):
+        """
+        Records a failed attempt for every job left running by `worker`, or
+        by any worker if None, after it died mid-job. The attempt counts, so
+        a job that keeps killing its worker eventually gives up. Returns the
+        number of jobs affected.
+        """
+        now = time.time()
+
+        def record(connection):
+            if worker is None:
+                rows = connection.execute(
+                    "SELECT id, attempts FROM jobs WHERE status = ?", (RUNNING,)
+                ).fetchall()
+            else:
+                rows = connection.execute(
+                    "SELECT id, attempts FROM jobs WHERE status = ? AND worker = ?",
+                    (RUNNING, worker),
+                ).fetchall()
+            for row in rows:
+                self._record_failure(connection, row["id"], row["attempts"], error, now)
+            return len(rows)
+
+        return self._transaction(record)
+
+    def recover(self):
+        """
+        Fails the attempts of jobs left running when the service last
+        stopped, requeueing those with attempts left. Only call this while
+        no workers are running.
+        """
+        recovered = self.abandon("Interrupted: the trigger service stopped while it was running")
+        if recovered:
+            logger.info(f"Requeued {recovered} interrupted jobs")
+        return recovered
+
+    def purge(self, keep_days=KEEP_DAYS):
+        """
+        Deletes finished jobs older than `keep_days`.
+        """
+        cutoff = time.time() - keep_days * 24 * 60 * 60
+        return self._transaction(
+            lambda connection: connection.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND finished < ?",
+                (DONE, FAILED, cutoff),
+            ).rowcount
+        )
+
+    def counts(self):
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall()
+        return {status: count for status, count in rows}
+
+
+def from_environment():
+    return JobQueue(QUEUE_PATH)
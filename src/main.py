@@ -3,8 +3,10 @@ import argparse
 
 import environment
 
+import job_queue
+import pipeline
+import worker_service
 from trigger import claude_api_trigger
-from dam_api.write_metadata import attach_metadata, attach_additional_tags
 import tagging_ai
 
 
@@ -13,27 +15,93 @@ logging.basicConfig(level=logging.INFO)
 
 
 def main(changelist):
-    file_process_dict: dict = claude_api_trigger.gather_file_process_list(changelist)
+    description = claude_api_trigger.get_changelist_description(changelist)
+    if not description:
+        return
 
+    files = claude_api_trigger.gather_changelist_files(description)
     logger.info(
-        f"Processing changelist {changelist}. {len(file_process_dict['file_list'])} files to process."
+        f"Processing changelist {changelist}. {len(files)} files to process."
     )
+    if not files:
+        return []
 
-    ai_results = tagging_ai.process_changelist(file_process_dict)
+    # Imported here so empty changelists exit before loading requests.
+    from dam_api.write_metadata import BatchWriter, get_client
 
-    for result in ai_results:
-        attach_metadata(
+    # The client outlives the changelist; only its latencies are per changelist.
+    dam_client = get_client()
+    dam_client.reset_latency_stats()
+    writer = BatchWriter(dam_client)
+
+    spend, duplicates = tagging_ai.start_changelist(changelist, description["desc"], len(files))
+
+    thumbnail_count = 0
+
+    def ready_files():
+        nonlocal thumbnail_count
+        for file in claude_api_trigger.iter_ready_files(files, changelist):
+            thumbnail_count += 1
+            yield file
+
+    def describe(files):
+        return tagging_ai.describe_files(files, description["desc"], duplicates, spend)
+
+    def write(result):
+        writer.add_metadata(
             result["depot_path"], "image description", result["description"]
         )
-        attach_additional_tags(result["depot_path"], result["tags"])
+        writer.add_tags(result["depot_path"], result["tags"])
+        writer.flush_if_due()
+        return result
+
+    # fetch -> describe -> write, with each file moving on as soon as it's ready.
+    # If fetching fails part way the error is raised here, after what was
+    # fetched has been written, so the job is retried.
+    try:
+        ai_results = pipeline.run_pipeline(
+            ready_files(),
+            [
+                pipeline.Stage(
+                    "describe",
+                    describe,
+                    tagging_ai.MAX_CONCURRENT_REQUESTS,
+                    batch_size=tagging_ai.BATCH_SIZE,
+                ),
+                pipeline.Stage("write", write),
+            ],
+        )
+    finally:
+        writer.flush()
+    tagging_ai.report_changelist(ai_results, spend, duplicates, len(files), thumbnail_count)
+    logger.info(f"DAM latency: {dam_client.latency_stats()}")
 
     logger.info(ai_results)
+
+    # Files held back by the daily budget are picked up again tomorrow; the
+    # ones already described come from the result cache at no cost.
+    run_after = spend.defer_until()
+    if run_after:
+        raise job_queue.DeferJob(run_after, f"with {spend.deferred} files over the daily budget")
     return ai_results
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("changelist")
+    parser.add_argument(
+        "--enqueue",
+        action="store_true",
+        help="queue the changelist for the worker service instead of running it now",
+    )
+    parser.add_argument("--priority", type=int, default=0, help="job priority when queued")
 
     parsed_args = parser.parse_args()
-    main(parsed_args.changelist)
+    if parsed_args.enqueue:
+        worker_service.enqueue(__file__, parsed_args.changelist, parsed_args.priority)
+    else:
+        try:
+            main(parsed_args.changelist)
+        except job_queue.DeferJob as deferral:
+            logger.info(deferral)
+            worker_service.enqueue(__file__, parsed_args.changelist, run_after=deferral.run_after)
@@ -0,0 +1,22 @@
+import os
+
+from P4 import P4
+
+
+# Number of depot files passed to a single `p4 fstat` call.
+FSTAT_BATCH_SIZE = int(os.environ.get("HELIX_FSTAT_BATCH_SIZE", 200))
+
+_p4 = None
+
+
+def get_p4():
+    """
+    Returns the P4 connection shared by the triggers of this process,
+    connecting on first use and again if the server dropped it since.
+    """
+    global _p4
+    if _p4 is None:
+        _p4 = P4()
+    if not _p4.connected():
+        _p4.connect()
+    return _p4
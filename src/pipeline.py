@@ -0,0 +1,146 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Items allowed to wait between two stages before the upstream stage blocks.
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 32))
+# Longest a batching stage waits for a batch to fill before running it.
+PIPELINE_BATCH_WAIT = float(os.environ.get("PIPELINE_BATCH_WAIT", 2))
+
+_DONE = object()
+
+
+class Stage:
+    """
+    A pipeline step run on `workers` threads. When `batch_size` is set the
+    function is called with a list of up to that many items, gathered for at
+    most `batch_wait` seconds, and returns a list of outputs.
+    """
+
+    def __init__(self, name, function, workers=1, batch_size=None, batch_wait=PIPELINE_BATCH_WAIT):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+
+def _next_batch(inbox, stage):
+    """
+    Takes the next batch of items off `inbox`, waiting for the first one.
+    Returns (items, done) where `done` means the end marker was reached.
+    """
+    item = inbox.get()
+    if item is _DONE:
+        return [], True
+
+    items = [item]
+    deadline = time.monotonic() + stage.batch_wait
+    while len(items) < stage.batch_size:
+        try:
+            item = inbox.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            break
+        if item is _DONE:
+            return items, True
+        items.append(item)
+    return items, False
+
+
+def run_pipeline(source, stages, queue_size=PIPELINE_QUEUE_SIZE):
+    """
+    Streams items from the `source` iterable through each Stage in turn. Every
+    stage runs on its own worker threads and is connected to the next by a
+    bounded queue, so a slow stage holds back the ones before it instead of
+    letting items pile up in memory.
+
+    A stage function returns the item to hand to the next stage, or None to
+    drop it. An exception drops only the item (or batch) that raised it.
+    Returns the items that made it out of the last stage, in completion order.
+
+    If the source raises, the items it already produced still run through
+    every stage and the exception is raised once they have, so the caller
+    doesn't mistake a partial run for a complete one.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    results = []
+    results_lock = threading.Lock()
+    source_error = []
+
+    def feed():
+        try:
+            for item in source:
+                queues[0].put(item)
+        except Exception as err:
+            source_error.append(err)
+        finally:
+            queues[0].put(_DONE)
+
+    def work(index, stage, remaining_workers):
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(queues) else None
+
+        done = False
+        while not done:
+            if stage.batch_size:
+                items, done = _next_batch(inbox, stage)
+            else:
+                item = inbox.get()
+                items, done = ([], True) if item is _DONE else ([item], False)
+
+            if done:
+                # Let this stage's other workers see the end marker too.
+                inbox.put(_DONE)
+            if not items:
+                continue
+
+            try:
+                if stage.batch_size:
+                    outputs = stage.function(items)
+                else:
+                    outputs = [stage.function(items[0])]
+            except Exception:
+                logger.exception(f"Pipeline stage {stage.name} failed on {len(items)} item(s)")
+                continue
+
+            for output in outputs:
+                if output is None:
+                    continue
+                if outbox is None:
+                    with results_lock:
+                        results.append(output)
+                else:
+                    outbox.put(output)
+
+        with remaining_workers["lock"]:
+            remaining_workers["count"] -= 1
+            last_worker = remaining_workers["count"] == 0
+        if last_worker and outbox is not None:
+            outbox.put(_DONE)
+
+    threads = [threading.Thread(target=feed, name="pipeline-source", daemon=True)]
+    for index, stage in enumerate(stages):
+        remaining_workers = {"count": stage.workers, "lock": threading.Lock()}
+        threads.extend(
+            threading.Thread(
+                target=work,
+                args=(index, stage, remaining_workers),
+                name=f"pipeline-{stage.name}-{worker}",
+                daemon=True,
+            )
+            for worker in range(stage.workers)
+        )
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if source_error:
+        raise source_error[0]
+    return results
@@ -3,12 +3,19 @@ import os
 import sys
 from pathlib import Path
 
+import worker_service
+
 python_executable = sys.executable
 
+# Queue changelists for the resident worker service instead of starting a
+# fresh interpreter per trigger. Set to "false" to always spawn a subprocess.
+USE_SERVICE = os.environ.get("TRIGGER_SERVICE_ENABLED", "true").lower() == "true"
+
 
 def run_subprocess(filepath, *args):
     output_filepath = Path(filepath).with_suffix(".log")
-    output_file = open(output_filepath, "w")
+    # Appended to, so a restart doesn't wipe the output of the run before it.
+    output_file = open(output_filepath, "a")
     process = subprocess.Popen(
         [f"{python_executable}", filepath, *args],
         stdout=output_file,
@@ -18,5 +25,36 @@ def run_subprocess(filepath, *args):
     print("Called subprocess with PID:", process.pid)
 
 
+def submit_to_service(filepath, changelist):
+    """
+    Queues the changelist for the worker service, starting the service if it
+    isn't running. Returns False, with the job taken back out of the queue,
+    if the service can't be reached.
+    """
+    job_id = None
+    try:
+        job_id = worker_service.enqueue(filepath, changelist, start=False)
+        worker_service.ensure_running()
+    except worker_service.UNAVAILABLE_ERRORS as err:
+        print("Trigger service unavailable:", repr(err))
+        # A job queued by an earlier trigger is left for the service; if it
+        # runs after this subprocess, the cached results make it cheap.
+        if job_id is None or worker_service.withdraw(job_id):
+            return False
+    print("Queued job:", job_id)
+    return True
+
+
+def dispatch(filepath, *args):
+    if (
+        USE_SERVICE
+        and len(args) == 1
+        and Path(filepath).name in worker_service.TRIGGERS
+        and submit_to_service(filepath, args[0])
+    ):
+        return
+    run_subprocess(filepath, *args)
+
+
 if __name__ == "__main__":
-    run_subprocess(*sys.argv[1:])
+    dispatch(*sys.argv[1:])
@@ -0,0 +1,84 @@
+import sqlite3
+import threading
+from pathlib import Path
+
+
+# Where the stores shared by every trigger process on the server live.
+DEFAULT_DIRECTORY = Path.home() / ".py_in_the_sky"
+
+
+class SqliteStore:
+    """
+    A SQLite file shared by every thread of a process and every process on
+    the server. The connection is opened on first use, creating the file and
+    running SCHEMA, so importing a module that owns a store stays cheap.
+    Subclasses hold `_lock` while they use the connection.
+    """
+
+    SCHEMA = ""
+    # Extra keyword arguments for sqlite3.connect.
+    CONNECT_OPTIONS = {}
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(
+                str(self.path), timeout=30, check_same_thread=False, **self.CONNECT_OPTIONS
+            )
+            self.prepare(connection)
+            self._connection = connection
+        return self._connection
+
+    def prepare(self, connection):
+        """
+        Sets up a newly opened connection. Override to tune the connection
+        before the schema is created.
+        """
+        connection.executescript(self.SCHEMA)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class SqliteCache(SqliteStore):
+    """
+    A SqliteStore that counts lookups, for the caches' hit rate reports.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.hits = 0
+        self.misses = 0
+
+    def count_lookup(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def open_store(store_class, path, *args, **kwargs):
+    """
+    Returns `store_class` for the file at `path`, or None if `path` is empty,
+    which is how each store's settings turn it off.
+    """
+    if not path:
+        return None
+    return store_class(path, *args, **kwargs)
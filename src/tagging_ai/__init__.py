@@ -1,48 +1,307 @@
-import asyncio
+import base64
 import json
 import logging
+import os
 
-from . import aws_claude
+from . import aws_claude, budget, result_cache, thumbnails
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Upper bound on Bedrock requests in flight at once for a single changelist.
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("TAGGING_AI_MAX_CONCURRENT_REQUESTS", 8))
+# Thumbnails described per Bedrock request. 1 sends one image per request.
+BATCH_SIZE = int(os.environ.get("TAGGING_AI_BATCH_SIZE", 1))
+
 claude = aws_claude.ClaudeHaiku()
+cache = result_cache.from_environment()
 
 
-def process_changelist(file_process_dict: dict):
-    items = []
-    for file in file_process_dict["file_list"]:
-        message = json.dumps(
-            {
-                "changelist_description": file_process_dict["desc"],
-                "filepath": file["depot_path"].split("@")[0],
-            }
-        )
-        items.append(
-            {
-                "depot_path": file["depot_path"],
-                "message": message,
-                "b64image": file["thumb"],
-                "image_type": file["thumb_type"],
-            }
-        )
-    output = []
+def start_changelist(changelist, changelist_description: str, file_count: int):
+    """
+    Sets up describing a changelist. Returns its budget.Budget, already
+    checked against the estimated cost of `file_count` files, and the
+    thumbnails.DuplicateTracker to share between its describe_files calls
+    so near-identical thumbnails are only described once.
+    """
+    spend = budget.from_environment(changelist)
+    spend.preflight(
+        file_count,
+        claude.system_prompt,
+        changelist_description,
+        thumbnails.MAX_EDGE,
+        BATCH_SIZE,
+    )
+    return spend, thumbnails.DuplicateTracker()
 
-    async def _process_items(items, output):
-        tasks = [_invoke_async(item) for item in items]
-        results = await asyncio.gather(*tasks)
-        output.extend(results)
 
-    asyncio.run(_process_items(items, output))
+def describe_files(files: list, changelist_description: str, duplicates=None, spend=None):
+    """
+    Describes a batch of FileRecords from the Helix trigger, one result (or
+    None) per file in the same order. Pass the changelist's
+    thumbnails.DuplicateTracker to describe near-identical thumbnails once,
+    and its budget.Budget to keep within the spend limits.
+    """
+    return describe_batch(
+        [build_item(file, changelist_description, _max_edge(spend)) for file in files],
+        duplicates,
+        spend,
+    )
 
-    total_cost = sum([result["cost"] for result in output])
+
+def report_changelist(
+    output: list, spend=None, duplicates=None, file_count=None, thumbnail_count=None
+):
+    """
+    Logs what describing a changelist cost and achieved. Of its `file_count`
+    files, `thumbnail_count` had a thumbnail to describe; the rest are
+    reported apart from the files Bedrock failed to describe.
+    """
+    # The budget also counts requests whose replies couldn't be used.
+    total_cost = spend.spent if spend else sum([result["cost"] for result in output])
     logger.info(f"Total Cost: ${total_cost}")
 
-    return output
+    if duplicates and duplicates.duplicates:
+        logger.info(f"{duplicates.duplicates} near-duplicate thumbnails reused a description")
+
+    if thumbnail_count is None:
+        thumbnail_count = file_count or 0
+    no_thumbnail = (file_count or 0) - thumbnail_count
+    if no_thumbnail > 0:
+        logger.warning(f"{no_thumbnail} of {file_count} files had no thumbnail to describe")
+
+    deferred = spend.deferred if spend else 0
+    failed = thumbnail_count - len(output) - deferred
+    if failed > 0:
+        logger.warning(f"{failed} of {thumbnail_count} thumbnails could not be described")
+    if deferred:
+        logger.warning(f"{deferred} files were deferred to stay within budget")
+
+    if spend:
+        logger.info(f"Budget: {spend.stats()}")
+        spend.close()
+
+    logger.info(f"Bedrock rate limiter: {claude.rate_limiter.stats()}")
+    logger.info(f"Bedrock token usage: {claude.usage_stats()}")
+
+    if cache:
+        cache.evict()
+        logger.info(f"Description cache: {cache.stats()}")
+
+
+def _max_edge(spend):
+    if spend and spend.downsample:
+        return spend.downsample_max_edge
+    return thumbnails.MAX_EDGE
 
 
-async def _invoke_async(item):
-    response = claude.invoke(item["message"], item["b64image"], item["image_type"])
+def build_item(file, changelist_description: str, max_edge: int = None):
+    message = json.dumps(
+        {
+            "changelist_description": changelist_description,
+            "filepath": file.depot_path.split("@")[0],
+        }
+    )
+    # Smaller, metadata-free thumbnails cost fewer input tokens. The cache key
+    # stays on the original bytes so it doesn't depend on these settings.
+    thumbnail = thumbnails.prepare(
+        file.thumb_bytes, file.thumb_type, max_edge=max_edge or thumbnails.MAX_EDGE
+    )
+    return {
+        "depot_path": file.depot_path,
+        "filepath": file.depot_path.split("@")[0],
+        "message": message,
+        "image": thumbnail.data,
+        "image_type": thumbnail.image_type,
+        "dhash": thumbnail.dhash,
+        "colors": thumbnail.colors,
+        "source": (file.thumb_bytes, file.thumb_type),
+        "cache_key": _cache_key(message, file.thumb_bytes),
+    }
+
+
+def _cache_key(message, image):
+    if not cache:
+        return None
+    return cache.make_key(image, claude.system_prompt, claude.model_id, message)
+
+
+def _cached_result(item):
+    if not item["cache_key"]:
+        return None
+    cached = cache.get(item["cache_key"])
+    if cached:
+        cached["cost"] = 0
+        cached["depot_path"] = item["depot_path"]
+    return cached
+
+
+def _store_result(item, response):
+    if item["cache_key"]:
+        cache.put(item["cache_key"], response)
     response["depot_path"] = item["depot_path"]
     return response
+
+
+def _invoke_item(item: dict):
+    """
+    Describes one item in its own request. Returns the result (or None) and
+    what the request cost, which is paid even if the reply can't be parsed.
+    """
+    try:
+        # Only encode the image for the request itself, so the base64 copy
+        # never outlives the call.
+        response, cost = claude.invoke(
+            item["message"], base64.b64encode(item["image"]), item["image_type"]
+        )
+    except Exception as err:
+        logger.error(f"Failed to describe {item['depot_path']}: {err}")
+        return None, 0.0
+
+    if not response:
+        return None, cost
+
+    return _store_result(item, response), cost
+
+
+def describe_batch(items: list, duplicates=None, spend=None):
+    """
+    Describes several items, one result (or None) per item in order. With a
+    thumbnails.DuplicateTracker, an item whose thumbnail is near-identical to
+    one already claimed in the changelist reuses that result at zero cost
+    instead of being sent to Bedrock. Reused results aren't written to the
+    result cache, so a wrong match lasts only for this changelist. With a
+    budget.Budget, items that don't fit the remaining budget are deferred
+    and come back as None.
+    """
+    if not duplicates:
+        return _describe_batch(items, spend)
+
+    claims = [duplicates.claim(item["dhash"], item["colors"]) for item in items]
+    firsts = [index for index, (_, is_first) in enumerate(claims) if is_first]
+
+    results = [None] * len(items)
+    try:
+        for index, result in zip(firsts, _describe_batch([items[index] for index in firsts], spend)):
+            results[index] = result
+    finally:
+        # Always resolve, so items waiting on these never block forever.
+        for index in firsts:
+            claims[index][0].set_result(results[index])
+
+    for index, (future, is_first) in enumerate(claims):
+        if is_first:
+            continue
+        original = future.result()
+        if original:
+            results[index] = dict(original, cost=0, depot_path=items[index]["depot_path"])
+        else:
+            results[index] = _describe_batch([items[index]], spend)[0]
+    return results
+
+
+def _describe_batch(items: list, spend=None):
+    """
+    Describes the items that aren't cached, returning one result (or None)
+    per item in order. Estimated costs are reserved against `spend` first
+    and the actual cost is settled afterwards.
+    """
+    results = [_cached_result(item) for item in items]
+    pending = [index for index, result in enumerate(results) if not result]
+
+    reserved = 0.0
+    if spend and spend.enabled and pending:
+        pending, reserved = _reserve(items, pending, spend)
+
+    cost = 0.0
+    try:
+        described, cost = _invoke_items([items[index] for index in pending])
+        for index, result in zip(pending, described):
+            results[index] = result
+    finally:
+        if spend:
+            spend.settle(reserved, cost, len(pending))
+    return results
+
+
+def _reserve(items, pending, spend):
+    """
+    Reserves the estimated cost of each pending item, retrying with a
+    downsampled thumbnail when it doesn't fit and deferring the item if it
+    still doesn't. Returns the indexes admitted and the total reserved.
+    """
+    system_tokens = budget.text_tokens(claude.system_prompt) / len(pending)
+    admitted = []
+    reserved = 0.0
+    for index in pending:
+        item = items[index]
+        cost = spend.estimate(item["message"], item["image"], system_tokens)
+        fits = spend.reserve(cost)
+        if not fits and _downsample(item, spend):
+            cost = spend.estimate(item["message"], item["image"], system_tokens)
+            fits = spend.reserve(cost)
+
+        if fits:
+            admitted.append(index)
+            reserved += cost
+        else:
+            logger.warning(f"Deferring {item['depot_path']}: over the {spend.limit_reached} budget")
+            spend.defer()
+    return admitted, reserved
+
+
+def _downsample(item, spend):
+    """
+    Shrinks the item's thumbnail to the budget's downsample size, and makes
+    later items start out that small. Returns False if it already was.
+    """
+    spend.downsample = True
+    if max(budget.image_size(item["image"])) <= spend.downsample_max_edge:
+        return False
+
+    thumbnail = thumbnails.prepare(*item["source"], max_edge=spend.downsample_max_edge)
+    item["image"] = thumbnail.data
+    item["image_type"] = thumbnail.image_type
+    return True
+
+
+def _invoke_items(items: list):
+    """
+    Describes uncached items with a single Bedrock request when there are
+    several. Items the batch response didn't cover, or every item if it
+    couldn't be parsed, are retried one image per request. Returns one result
+    (or None) per item and the cost of every request made, including ones
+    whose replies couldn't be used.
+    """
+    described, cost = {}, 0.0
+    if len(items) >= 2:
+        try:
+            described, cost = claude.invoke_batch(
+                [
+                    (
+                        item["filepath"],
+                        item["message"],
+                        base64.b64encode(item["image"]),
+                        item["image_type"],
+                    )
+                    for item in items
+                ]
+            )
+        except Exception as err:
+            logger.error(f"Failed to describe a batch of {len(items)} files: {err}")
+
+        described = described or {}
+        if len(described) < len(items):
+            logger.warning(
+                f"Batch covered {len(described)} of {len(items)} files, describing the rest one by one"
+            )
+
+    results = []
+    for item in items:
+        if item["filepath"] in described:
+            results.append(_store_result(item, described[item["filepath"]]))
+        else:
+            result, item_cost = _invoke_item(item)
+            results.append(result)
+            cost += item_cost
+    return results, cost
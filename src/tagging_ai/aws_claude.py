@@ -4,13 +4,16 @@
 Shows how to run a multimodal prompt with Anthropic Claude (on demand) and InvokeModel.
 """
 
+import os
 import json
+import time
+import random
 import logging
 import base64
+import threading
 from pathlib import Path
 
-import boto3
-from botocore.exceptions import ClientError
+from . import budget, rate_limiter
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -18,6 +21,40 @@ logging.basicConfig(level=logging.INFO)
 
 INPUT_TOKEN_PRICE = 0.00000025
 OUTPUT_TOKEN_PRICE = 0.00000125
+# Prompt cache writes and reads, relative to INPUT_TOKEN_PRICE.
+CACHE_WRITE_PRICE_MULTIPLIER = 1.25
+CACHE_READ_PRICE_MULTIPLIER = 0.1
+
+# Mark the system prompt as a cacheable prefix so later requests read it at
+# the cache price. Only some Bedrock models support prompt caching, and
+# prompts shorter than PROMPT_CACHE_MIN_TOKENS are never cached.
+PROMPT_CACHING = os.environ.get("TAGGING_AI_PROMPT_CACHING", "false").lower() in ("1", "true", "yes")
+PROMPT_CACHE_MIN_TOKENS = int(os.environ.get("TAGGING_AI_PROMPT_CACHE_MIN_TOKENS", 2048))
+
+# Attempts per request when Bedrock throttles or fails transiently. botocore's
+# own retries are turned off so every attempt goes through the rate limiter.
+MAX_ATTEMPTS = int(os.environ.get("TAGGING_AI_MAX_ATTEMPTS", 6))
+RETRY_BASE_DELAY = float(os.environ.get("TAGGING_AI_RETRY_BASE_DELAY", 1))
+RETRY_MAX_DELAY = float(os.environ.get("TAGGING_AI_RETRY_MAX_DELAY", 30))
+
+THROTTLING_ERRORS = {"ThrottlingException", "TooManyRequestsException"}
+TRANSIENT_ERRORS = {
+    "ServiceUnavailableException",
+    "InternalServerException",
+    "ModelTimeoutException",
+    "ModelNotReadyException",
+}
+
+# Largest response Claude 3 Haiku can produce, which caps batched requests.
+MAX_OUTPUT_TOKENS = 4096
+
+BATCH_INSTRUCTIONS = """Each image above is preceded by the information for that asset, including its "filepath". Describe every image separately following the system instructions, and reply with only a JSON array containing one object per image, in the same order, each with the keys "filepath", "tags" and "description". Copy each "filepath" exactly as given."""
+
+# Prompt file read at startup. Falls back to DEFAULT_SYSTEM_PROMPT if the file
+# doesn't exist; set to an empty string to always use the default.
+SYSTEM_PROMPT_PATH = os.environ.get(
+    "TAGGING_AI_SYSTEM_PROMPT_PATH", str(Path(__file__).with_name("system_prompt.txt"))
+)
 
 
 DEFAULT_SYSTEM_PROMPT = """Look at the thumbnail image of this digital asset as well as any extra information provided such as file name, path, changelist description, and asset type, to create a list of tags for searching and categorizing, as well as a short description of the image so that a user could understand it without seeing the image.
@@ -73,84 +110,264 @@ Here are some examples:
 """
 
 
+def load_system_prompt(path=SYSTEM_PROMPT_PATH, default_prompt=DEFAULT_SYSTEM_PROMPT):
+    """
+    Returns the contents of the prompt file at `path`, or `default_prompt` if
+    no path is set or the file doesn't exist.
+    """
+    if path and Path(path).is_file():
+        return Path(path).read_text()
+    if path:
+        logger.warning(f"System prompt {path} not found, using the default prompt")
+    return default_prompt
+
+
 class ClaudeHaiku:
-    def __init__(self):
+    def __init__(self, system_prompt_path=SYSTEM_PROMPT_PATH, prompt_caching=PROMPT_CACHING):
         self.model_id = "anthropic.claude-3-haiku-20240307-v1:0"
-        self.bedrock_runtime = boto3.client(service_name="bedrock-runtime")
         self.max_tokens = 1024
-        self.system_prompt = self._find_system_prompt_file(DEFAULT_SYSTEM_PROMPT)
+        self.system_prompt = load_system_prompt(system_prompt_path)
+        self.prompt_caching = prompt_caching
+        self.rate_limiter = rate_limiter.from_environment()
+        self.usage = {
+            "input_tokens": 0,
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 0,
+            "output_tokens": 0,
+        }
+        self._usage_lock = threading.Lock()
+        self._bedrock_runtime = None
+        self._client_lock = threading.Lock()
+
+        if prompt_caching and budget.text_tokens(self.system_prompt) < PROMPT_CACHE_MIN_TOKENS:
+            logger.warning(
+                f"The system prompt is about {budget.text_tokens(self.system_prompt)} tokens, below"
+                f" the {PROMPT_CACHE_MIN_TOKENS} token minimum for prompt caching, so it won't be cached"
+            )
 
-    def _find_system_prompt_file(self, default_prompt):
+    @property
+    def bedrock_runtime(self):
         """
-        Searches for a file called system_prompt.txt and returns its path if found.
-        Returns:
-            str: The path of the system_prompt.txt file if found, otherwise an empty string.
+        The Bedrock runtime client, created on the first request so importing
+        and constructing ClaudeHaiku stays cheap.
         """
-        current_dir = Path.cwd()
-        for file in current_dir.glob("**/system_prompt.txt"):
-            return file.read_text()
-        return default_prompt
+        if self._bedrock_runtime is None:
+            with self._client_lock:
+                if self._bedrock_runtime is None:
+                    # boto3 takes a noticeable share of startup, so it's only
+                    # imported once a request is actually made.
+                    import boto3
+                    from botocore.config import Config
+
+                    self._bedrock_runtime = boto3.client(
+                        service_name="bedrock-runtime",
+                        config=Config(retries={"max_attempts": 1, "mode": "standard"}),
+                    )
+        return self._bedrock_runtime
 
     def invoke(self, message, b64image, image_type):
         messages = [
             {
                 "role": "user",
                 "content": [
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": image_type,
-                            "data": (
-                                b64image.decode("utf-8")
-                                if isinstance(b64image, bytes)
-                                else b64image
-                            ),
-                        },
-                    },
+                    self._image_block(b64image, image_type),
                     {"type": "text", "text": message},
                 ],
             }
         ]
         response = self._invoke_model(messages)
+        # Priced before parsing, as an unparseable reply is paid for too.
+        cost = self._response_cost(response)
+        logger.info(f"Total Cost: ${cost}")
         try:
             response_message = json.loads(response["content"][0]["text"])
-            input_cost = response["usage"]["input_tokens"] * INPUT_TOKEN_PRICE
-            output_cost = response["usage"]["output_tokens"] * OUTPUT_TOKEN_PRICE
-            logger.info(f"Total Cost: ${input_cost + output_cost}")
-            response_message["cost"] = input_cost + output_cost
-            return response_message
-
         except json.JSONDecodeError as err:
-            message = err.response["Error"]["Message"]
-            logger.error("Response was not valid JSON: %s", message)
+            logger.error("Response was not valid JSON: %s", err)
+            return None, cost
+
+        response_message["cost"] = cost
+        return response_message, cost
+
+    def invoke_batch(self, entries):
+        """
+        Describes several images in one request so the system prompt is only
+        paid for once. `entries` is a list of (filepath, message, b64image,
+        image_type). Returns ({filepath: result}, cost), where the results
+        cover the images the response described, each carrying an equal share
+        of the request cost. The results are None if the response couldn't be
+        parsed; the request was still paid for, so its cost is returned
+        either way.
+        """
+        content = []
+        for filepath, message, b64image, image_type in entries:
+            content.append({"type": "text", "text": message})
+            content.append(self._image_block(b64image, image_type))
+        content.append({"type": "text", "text": BATCH_INSTRUCTIONS})
+
+        response = self._invoke_model(
+            [{"role": "user", "content": content}],
+            max_tokens=min(self.max_tokens * len(entries), MAX_OUTPUT_TOKENS),
+        )
+
+        cost = self._response_cost(response)
+        text = response["content"][0]["text"]
+        try:
+            described = json.loads(text[text.index("[") : text.rindex("]") + 1])
+        except ValueError as err:
+            logger.error(f"Batch response was not a valid JSON array: {err}")
+            logger.info(f"Total Cost: ${cost} for 0 of {len(entries)} images")
+            return None, cost
+
+        filepaths = {entry[0] for entry in entries}
+        results = {}
+        for result in described:
+            if isinstance(result, dict) and result.get("filepath") in filepaths:
+                results[result.pop("filepath")] = result
+
+        logger.info(f"Total Cost: ${cost} for {len(results)} of {len(entries)} images")
+        for result in results.values():
+            result["cost"] = cost / len(results)
+        return results, cost
+
+    @staticmethod
+    def _image_block(b64image, image_type):
+        return {
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": image_type,
+                "data": (
+                    b64image.decode("utf-8") if isinstance(b64image, bytes) else b64image
+                ),
+            },
+        }
+
+    def _response_cost(self, response):
+        """
+        Prices a response's usage, with prompt cache writes and reads at their
+        own rates, and adds it to the running token totals.
+        """
+        usage = response["usage"]
+        with self._usage_lock:
+            for key in self.usage:
+                self.usage[key] += usage.get(key) or 0
+
+        input_cost = (
+            usage["input_tokens"]
+            + (usage.get("cache_creation_input_tokens") or 0) * CACHE_WRITE_PRICE_MULTIPLIER
+            + (usage.get("cache_read_input_tokens") or 0) * CACHE_READ_PRICE_MULTIPLIER
+        ) * INPUT_TOKEN_PRICE
+        output_cost = usage["output_tokens"] * OUTPUT_TOKEN_PRICE
+        return input_cost + output_cost
+
+    def usage_stats(self):
+        with self._usage_lock:
+            usage = dict(self.usage)
+        prompt_tokens = (
+            usage["input_tokens"]
+            + usage["cache_creation_input_tokens"]
+            + usage["cache_read_input_tokens"]
+        )
+        usage["cache_read_ratio"] = (
+            usage["cache_read_input_tokens"] / prompt_tokens if prompt_tokens else 0.0
+        )
+        return usage
 
-    def _invoke_model(self, messages):
+    def _system(self, prompt_caching):
+        if not prompt_caching:
+            return self.system_prompt
+        return [
+            {
+                "type": "text",
+                "text": self.system_prompt,
+                "cache_control": {"type": "ephemeral"},
+            }
+        ]
+
+    @staticmethod
+    def _rejects_prompt_caching(err):
+        """
+        Whether a ClientError is the model refusing the cache_control block,
+        rather than a validation error about the rest of the request (an
+        oversized image, a malformed batch) that retrying wouldn't fix.
+        """
+        error = err.response.get("Error", {})
+        message = error.get("Message", "").lower()
+        return error.get("Code") == "ValidationException" and (
+            "cache_control" in message or "caching" in message
+        )
+
+    def _invoke_model(self, messages, max_tokens=None):
         """
         Invokes a model with a multimodal prompt.
         Args:
             bedrock_runtime: The Amazon Bedrock boto3 client.
             model_id (str): The model ID to use.
             messages (JSON) : The messages to send to the model.
-            max_tokens (int) : The maximum  number of tokens to generate.
+            max_tokens (int) : The maximum  number of tokens to generate, defaults to self.max_tokens.
         Returns:
             None.
         """
 
-        body = json.dumps(
-            {
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": self.max_tokens,
-                "system": self.system_prompt,
-                "messages": messages,
-            }
-        )
+        from botocore.exceptions import ClientError
+
+        prompt_caching = self.prompt_caching
+        body = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": max_tokens or self.max_tokens,
+            "system": self._system(prompt_caching),
+            "messages": messages,
+        }
 
-        response = self.bedrock_runtime.invoke_model(body=body, modelId=self.model_id)
+        try:
+            response = self._invoke_with_retries(json.dumps(body))
+        except ClientError as err:
+            if not prompt_caching or not self._rejects_prompt_caching(err):
+                raise
+            # Models without prompt caching reject cache_control; carry on
+            # without it rather than failing every request.
+            with self._client_lock:
+                if self.prompt_caching:
+                    logger.warning(f"Prompt caching rejected by {self.model_id}, turning it off: {err}")
+                    self.prompt_caching = False
+            body["system"] = self._system(False)
+            response = self._invoke_with_retries(json.dumps(body))
         response_body = json.loads(response.get("body").read())
 
         return response_body
 
+    def _invoke_with_retries(self, body):
+        """
+        Calls invoke_model through the shared rate limiter, retrying throttled
+        and transient failures with full-jitter exponential backoff. Other
+        errors, and the last failed attempt, are raised.
+        """
+        from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            started = self.rate_limiter.acquire()
+            try:
+                response = self.bedrock_runtime.invoke_model(body=body, modelId=self.model_id)
+            except ClientError as err:
+                code = err.response.get("Error", {}).get("Code")
+                if code in THROTTLING_ERRORS:
+                    self.rate_limiter.on_throttle(started)
+                elif code not in TRANSIENT_ERRORS:
+                    raise
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                logger.warning(f"Bedrock {code} on attempt {attempt}, retrying")
+            except (ConnectionError, HTTPClientError) as err:
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                logger.warning(f"Bedrock connection failed on attempt {attempt}, retrying: {err}")
+            else:
+                self.rate_limiter.on_success()
+                return response
+
+            self.rate_limiter.on_retry()
+            time.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))))
+
 
 def main():
     """
@@ -171,7 +388,7 @@ def main():
     with open(input_image, "rb") as image_file:
         content_image = base64.b64encode(image_file.read()).decode("utf8")
 
-    res = claude.invoke(input_text, content_image, "image/png")
+    res, _ = claude.invoke(input_text, content_image, "image/png")
     logger.info(res)
     print(res)
     return res
@@ -0,0 +1,240 @@
+import datetime
+import io
+import logging
+import math
+import os
+import threading
+import time
+
+import sqlite_store
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+DEFAULT_LEDGER_PATH = sqlite_store.DEFAULT_DIRECTORY / "spend_ledger.sqlite3"
+
+# Set TAGGING_AI_SPEND_LEDGER_PATH to an empty string to only count the
+# spend of the current run.
+LEDGER_PATH = os.environ.get("TAGGING_AI_SPEND_LEDGER_PATH", str(DEFAULT_LEDGER_PATH))
+# Spend limits in USD. 0 means no limit.
+CHANGELIST_BUDGET = float(os.environ.get("TAGGING_AI_CHANGELIST_BUDGET", 0))
+DAILY_BUDGET = float(os.environ.get("TAGGING_AI_DAILY_BUDGET", 0))
+# Longest thumbnail edge used once a changelist is expected to go over budget.
+DOWNSAMPLE_MAX_EDGE = int(os.environ.get("TAGGING_AI_DOWNSAMPLE_MAX_EDGE", 256))
+# Expected response length per image, for estimates made before the call.
+ESTIMATED_OUTPUT_TOKENS = int(os.environ.get("TAGGING_AI_ESTIMATED_OUTPUT_TOKENS", 200))
+
+# Claude scales images down to fit this edge, then bills pixels / 750 tokens.
+IMAGE_MAX_EDGE = 1568
+PIXELS_PER_TOKEN = 750
+CHARACTERS_PER_TOKEN = 3.5
+
+
+def image_size(data, default_edge=DOWNSAMPLE_MAX_EDGE):
+    """
+    Returns (width, height) read from the image header, or a square of
+    `default_edge` if Pillow is missing or can't read it.
+    """
+    try:
+        from PIL import Image
+
+        with Image.open(io.BytesIO(data)) as image:
+            return image.size
+    except Exception:
+        return default_edge, default_edge
+
+
+def image_tokens(width, height):
+    scale = min(1.0, IMAGE_MAX_EDGE / max(width, height, 1))
+    return math.ceil(width * scale * height * scale / PIXELS_PER_TOKEN)
+
+
+def text_tokens(text):
+    return math.ceil(len(text) / CHARACTERS_PER_TOKEN)
+
+
+def estimate_cost(input_tokens, output_tokens):
+    from .aws_claude import INPUT_TOKEN_PRICE, OUTPUT_TOKEN_PRICE
+
+    return input_tokens * INPUT_TOKEN_PRICE + output_tokens * OUTPUT_TOKEN_PRICE
+
+
+class SpendLedger(sqlite_store.SqliteStore):
+    """
+    Persistent record of Bedrock spend per changelist and day, shared by
+    every process on the server.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS spend (
+            id INTEGER PRIMARY KEY,
+            day TEXT NOT NULL,
+            changelist INTEGER,
+            images INTEGER NOT NULL,
+            cost REAL NOT NULL,
+            created REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS spend_day ON spend (day);
+        CREATE INDEX IF NOT EXISTS spend_changelist ON spend (changelist);
+    """
+
+    @staticmethod
+    def today():
+        return datetime.date.today().isoformat()
+
+    def record(self, changelist, cost, images):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO spend (day, changelist, images, cost, created) VALUES (?, ?, ?, ?, ?)",
+                (self.today(), changelist, images, cost, time.time()),
+            )
+
+    def spent_today(self):
+        with self._lock:
+            return self.connection.execute(
+                "SELECT COALESCE(SUM(cost), 0) FROM spend WHERE day = ?", (self.today(),)
+            ).fetchone()[0]
+
+    def spent_on_changelist(self, changelist):
+        with self._lock:
+            return self.connection.execute(
+                "SELECT COALESCE(SUM(cost), 0) FROM spend WHERE changelist = ?", (changelist,)
+            ).fetchone()[0]
+
+
+class Budget:
+    """
+    Keeps one changelist's Bedrock spend within the per-changelist and daily
+    limits. Each request reserves its estimated cost first and settles the
+    actual cost in the ledger afterwards. When the estimate no longer fits,
+    thumbnails are downsampled to DOWNSAMPLE_MAX_EDGE; files that still
+    don't fit are deferred. Work deferred by the daily limit can be retried
+    from `defer_until()`, with the result cache keeping the rerun cheap.
+    """
+
+    def __init__(
+        self,
+        changelist,
+        ledger=None,
+        changelist_limit=CHANGELIST_BUDGET,
+        daily_limit=DAILY_BUDGET,
+        downsample_max_edge=DOWNSAMPLE_MAX_EDGE,
+    ):
+        self.changelist = changelist
+        self.ledger = ledger
+        self.changelist_limit = changelist_limit
+        self.daily_limit = daily_limit
+        self.downsample_max_edge = downsample_max_edge
+        self.downsample = False
+        self.reserved = 0.0
+        self.spent = 0.0
+        self.deferred = 0
+        self.limit_reached = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.changelist_limit or self.daily_limit)
+
+    def _remaining(self):
+        remaining = {}
+        if self.changelist_limit:
+            spent = (
+                self.ledger.spent_on_changelist(self.changelist) if self.ledger else self.spent
+            )
+            remaining["changelist"] = self.changelist_limit - spent - self.reserved
+        if self.daily_limit:
+            spent = self.ledger.spent_today() if self.ledger else self.spent
+            remaining["daily"] = self.daily_limit - spent - self.reserved
+        return remaining
+
+    def estimate(self, message, image, system_tokens=0):
+        """
+        Estimates the cost of describing one image, with `system_tokens` of
+        the system prompt attributed to it.
+        """
+        width, height = image_size(image)
+        input_tokens = image_tokens(width, height) + text_tokens(message) + system_tokens
+        return estimate_cost(input_tokens, ESTIMATED_OUTPUT_TOKENS)
+
+    def preflight(self, file_count, system_prompt, message, thumb_edge, batch_size=1):
+        """
+        Estimates the whole changelist before any call is made, assuming
+        square thumbnails of `thumb_edge` and the system prompt sent once per
+        batch, and switches to downsampled thumbnails straight away if that
+        wouldn't fit.
+        """
+        per_file = estimate_cost(
+            image_tokens(thumb_edge, thumb_edge)
+            + text_tokens(message)
+            + text_tokens(system_prompt) / batch_size,
+            ESTIMATED_OUTPUT_TOKENS,
+        )
+        estimate = per_file * file_count
+        logger.info(f"Estimated cost for {file_count} files: ${estimate:.4f}")
+        if not self.enabled:
+            return estimate
+
+        with self._lock:
+            remaining = self._remaining()
+        if estimate > min(remaining.values()):
+            logger.warning(
+                f"Estimate exceeds the remaining budget {remaining}, downsampling thumbnails"
+                f" to {self.downsample_max_edge}px"
+            )
+            self.downsample = True
+        return estimate
+
+    def reserve(self, cost):
+        """
+        Sets `cost` aside if it fits every limit. Returns False, recording
+        which limit was reached, if it doesn't.
+        """
+        if not self.enabled:
+            return True
+        with self._lock:
+            for limit, remaining in self._remaining().items():
+                if cost > remaining:
+                    self.limit_reached = self.limit_reached or limit
+                    return False
+            self.reserved += cost
+            return True
+
+    def defer(self, count=1):
+        with self._lock:
+            self.deferred += count
+
+    def settle(self, reserved, cost, images):
+        with self._lock:
+            self.reserved -= reserved
+            self.spent += cost
+        if self.ledger and cost:
+            self.ledger.record(self.changelist, cost, images)
+
+    def defer_until(self):
+        """
+        Returns when deferred work should be retried: the start of tomorrow
+        if the daily limit was reached, otherwise None, as rerunning won't
+        lower what the changelist itself has spent.
+        """
+        if not self.deferred or self.limit_reached != "daily":
+            return None
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        return time.mktime(tomorrow.timetuple())
+
+    def close(self):
+        if self.ledger:
+            self.ledger.close()
+
+    def stats(self):
+        return {
+            "spent": self.spent,
+            "deferred": self.deferred,
+            "downsampled": self.downsample,
+            "limit_reached": self.limit_reached,
+        }
+
+
+def from_environment(changelist):
+    return Budget(changelist, sqlite_store.open_store(SpendLedger, LEDGER_PATH))
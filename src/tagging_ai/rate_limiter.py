@@ -0,0 +1,121 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+# Bedrock requests per second allowed to start, per process. The rate grows
+# by RATE_INCREASE after every successful call up to RATE_LIMIT_MAX and is
+# multiplied by RATE_DECREASE when Bedrock throttles.
+RATE_LIMIT = float(os.environ.get("TAGGING_AI_RATE_LIMIT", 4))
+RATE_LIMIT_MIN = float(os.environ.get("TAGGING_AI_RATE_LIMIT_MIN", 0.2))
+RATE_LIMIT_MAX = float(os.environ.get("TAGGING_AI_RATE_LIMIT_MAX", 20))
+RATE_INCREASE = float(os.environ.get("TAGGING_AI_RATE_INCREASE", 0.1))
+RATE_DECREASE = float(os.environ.get("TAGGING_AI_RATE_DECREASE", 0.5))
+# Requests that may start back to back after an idle period.
+BURST = float(os.environ.get("TAGGING_AI_RATE_BURST", 4))
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket shared by every thread calling Bedrock, with AIMD
+    adaptation: the rate creeps up while calls succeed and is cut sharply
+    when they are throttled, settling just under the account's real limit.
+
+    acquire() reserves its slot and then sleeps outside the lock, so waiting
+    callers start in turn at the current rate. It returns the request's start
+    time, which the caller passes back to on_throttle() so that throttles of
+    requests already in flight when the rate was cut don't cut it again.
+    """
+
+    def __init__(
+        self,
+        rate=RATE_LIMIT,
+        min_rate=RATE_LIMIT_MIN,
+        max_rate=RATE_LIMIT_MAX,
+        increase=RATE_INCREASE,
+        decrease=RATE_DECREASE,
+        burst=BURST,
+    ):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.last_decrease = 0.0
+
+        self.requests = 0
+        self.throttles = 0
+        self.retries = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, units=1):
+        """
+        Blocks until `units` requests may start and returns the start time,
+        on the time.monotonic() clock.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= units
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.requests += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+        if wait:
+            time.sleep(wait)
+        return time.monotonic()
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, started=None):
+        """
+        Cuts the rate and empties the bucket, unless the throttled request
+        `started` (as returned by acquire()) before the rate was last cut: a
+        burst of throttles from requests already in flight then counts as a
+        single cut.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.throttles += 1
+            if started is not None and started < self.last_decrease:
+                return
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = min(self.tokens, 0)
+            self.last_decrease = now
+        logger.warning(f"Bedrock throttled, lowering the request rate to {self.rate:.2f}/s")
+
+    def on_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rate": round(self.rate, 2),
+                "requests": self.requests,
+                "throttles": self.throttles,
+                "throttle_rate": self.throttles / self.requests if self.requests else 0.0,
+                "retries": self.retries,
+                "average_wait": self.total_wait / self.requests if self.requests else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+
+def from_environment():
+    return AdaptiveRateLimiter()
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+import sqlite_store
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+DEFAULT_CACHE_PATH = sqlite_store.DEFAULT_DIRECTORY / "description_cache.sqlite3"
+
+# Set TAGGING_AI_CACHE_PATH to an empty string to disable the cache.
+CACHE_PATH = os.environ.get("TAGGING_AI_CACHE_PATH", str(DEFAULT_CACHE_PATH))
+CACHE_MAX_ENTRIES = int(os.environ.get("TAGGING_AI_CACHE_MAX_ENTRIES", 100000))
+CACHE_MAX_AGE_DAYS = float(os.environ.get("TAGGING_AI_CACHE_MAX_AGE_DAYS", 90))
+
+# Keys that describe a single invocation rather than the image itself.
+UNCACHED_KEYS = ("cost", "depot_path")
+
+
+class ResultCache(sqlite_store.SqliteCache):
+    """
+    Persistent store of AI descriptions keyed on the content that produced
+    them: the thumbnail bytes, the system prompt, the model id and the
+    message (file path and changelist description) sent along with it.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS descriptions (
+            key TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS descriptions_created_at ON descriptions (created_at);
+    """
+
+    def __init__(self, path, max_entries=CACHE_MAX_ENTRIES, max_age_days=CACHE_MAX_AGE_DAYS):
+        super().__init__(path)
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+
+    @staticmethod
+    def make_key(image_bytes, system_prompt, model_id, message):
+        digest = hashlib.sha256()
+        for part in (image_bytes, system_prompt, model_id, message):
+            if isinstance(part, str):
+                part = part.encode("utf-8")
+            digest.update(hashlib.sha256(part).digest())
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT result, created_at FROM descriptions WHERE key = ?", (key,)
+            ).fetchone()
+
+        hit = row is not None and time.time() - row[1] <= self.max_age_seconds
+        self.count_lookup(hit)
+        return json.loads(row[0]) if hit else None
+
+    def put(self, key, result):
+        cached_result = {k: v for k, v in result.items() if k not in UNCACHED_KEYS}
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO descriptions (key, result, created_at) VALUES (?, ?, ?)",
+                (key, json.dumps(cached_result), time.time()),
+            )
+            self.connection.commit()
+
+    def evict(self):
+        """
+        Drops entries older than the maximum age, then the oldest entries
+        beyond the maximum entry count.
+        """
+        with self._lock:
+            connection = self.connection
+            expired = connection.execute(
+                "DELETE FROM descriptions WHERE created_at < ?",
+                (time.time() - self.max_age_seconds,),
+            ).rowcount
+            overflow = connection.execute(
+                """
+                DELETE FROM descriptions WHERE key IN (
+                    SELECT key FROM descriptions ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            ).rowcount
+            connection.commit()
+
+        if expired or overflow:
+            logger.info(f"Evicted {expired} expired and {overflow} excess cached descriptions")
+
+
+def from_environment():
+    return sqlite_store.open_store(ResultCache, CACHE_PATH)
@@ -0,0 +1,191 @@
+import io
+import logging
+import os
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+# Longest edge, in pixels, of the image sent to Bedrock. Image input tokens
+# grow with pixel count. 0 keeps the original size.
+MAX_EDGE = int(os.environ.get("TAGGING_AI_THUMB_MAX_EDGE", 512))
+MEDIA_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp"}
+
+# "jpeg" or "webp". An empty string sends the original bytes untouched.
+FORMAT = os.environ.get("TAGGING_AI_THUMB_FORMAT", "jpeg").lower()
+if FORMAT and FORMAT not in MEDIA_TYPES:
+    raise ValueError(
+        f"TAGGING_AI_THUMB_FORMAT must be one of {', '.join(MEDIA_TYPES)} or empty, not {FORMAT!r}"
+    )
+QUALITY = int(os.environ.get("TAGGING_AI_THUMB_QUALITY", 85))
+# Thumbnails whose dHashes differ in at most this many of their 64 bits, and
+# whose average colors per quadrant differ by at most DEDUPE_COLOR_DISTANCE
+# in every channel, are described once per changelist. The dHash only sees
+# brightness, hence the color check. Negative (the default) disables
+# deduplication.
+DEDUPE_DISTANCE = int(os.environ.get("TAGGING_AI_DEDUPE_DISTANCE", -1))
+DEDUPE_COLOR_DISTANCE = int(os.environ.get("TAGGING_AI_DEDUPE_COLOR_DISTANCE", 12))
+
+_warned_missing_pillow = False
+
+
+class Thumbnail:
+    __slots__ = ("data", "image_type", "dhash", "colors")
+
+    def __init__(self, data, image_type, dhash=None, colors=None):
+        self.data = data
+        self.image_type = image_type
+        self.dhash = dhash
+        self.colors = colors
+
+
+def prepare(data, image_type, max_edge=MAX_EDGE, image_format=FORMAT, quality=QUALITY):
+    """
+    Shrinks a thumbnail to `max_edge` and re-encodes it without metadata,
+    returning a Thumbnail with its difference hash and quadrant colors, for
+    deduplication. The re-encoded image is sent even when it's larger than
+    the original, so no metadata reaches Bedrock. The original bytes are
+    returned as they are if `image_format` is empty, or Pillow is missing
+    or can't decode them.
+    """
+    global _warned_missing_pillow
+    try:
+        # Pillow is only loaded once there is an image to prepare.
+        from PIL import Image
+    except ImportError:
+        if not _warned_missing_pillow:
+            logger.warning("Pillow is not installed, sending thumbnails unprocessed")
+            _warned_missing_pillow = True
+        return Thumbnail(data, image_type)
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.load()
+            dhash = difference_hash(image)
+            colors = quadrant_colors(image)
+
+            if not image_format:
+                return Thumbnail(data, image_type, dhash, colors)
+
+            if max_edge and max(image.size) > max_edge:
+                image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            encoded = _encode(image, image_format, quality)
+    except Exception as err:
+        logger.warning(f"Could not preprocess thumbnail: {err}")
+        return Thumbnail(data, image_type)
+
+    return Thumbnail(encoded, MEDIA_TYPES[image_format], dhash, colors)
+
+
+def _encode(image, image_format, quality):
+    from PIL import Image
+
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        if image_format == "jpeg":
+            # JPEG has no alpha, so flatten onto white as the HelixSearch
+            # thumbnails are usually viewed.
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    output = io.BytesIO()
+    # No exif or icc_profile is passed, so the output carries no metadata.
+    image.save(output, format=image_format.upper(), quality=quality, optimize=image_format == "jpeg")
+    return output.getvalue()
+
+
+def difference_hash(image, size=8):
+    """
+    Returns the 64-bit dHash of a PIL image: whether each pixel of a
+    (size + 1) x size greyscale reduction is brighter than its right
+    neighbour.
+    """
+    from PIL import Image
+
+    pixels = list(image.convert("L").resize((size + 1, size), Image.BILINEAR).getdata())
+    dhash = 0
+    for row in range(size):
+        for column in range(size):
+            left = pixels[row * (size + 1) + column]
+            right = pixels[row * (size + 1) + column + 1]
+            dhash = (dhash << 1) | (left > right)
+    return dhash
+
+
+def quadrant_colors(image):
+    """
+    Returns the average (R, G, B) of each quadrant of a PIL image as one flat
+    tuple, which tells apart images whose brightness matches but whose
+    colors don't, like the same chair in red and in blue.
+    """
+    from PIL import Image
+
+    return tuple(image.convert("RGB").resize((2, 2), Image.BOX).tobytes())
+
+
+def hamming_distance(first, second):
+    return bin(first ^ second).count("1")
+
+
+def color_distance(first, second):
+    return max(abs(a - b) for a, b in zip(first, second))
+
+
+class DuplicateTracker:
+    """
+    Groups the thumbnails of a changelist by dHash and quadrant colors so
+    each group of near-identical images is only described once. The first
+    thumbnail of a group gets a Future to resolve with its result and later
+    ones get that same Future to wait on.
+
+    The hash is split into `max_distance + 1` bands: two hashes within
+    `max_distance` bits must agree exactly on at least one band, so only
+    thumbnails sharing a band are compared.
+    """
+
+    def __init__(self, max_distance=DEDUPE_DISTANCE, max_color_distance=DEDUPE_COLOR_DISTANCE):
+        self.max_distance = max_distance
+        self.max_color_distance = max_color_distance
+        self.bands = max_distance + 1
+        self.band_bits = -(-64 // self.bands) if self.bands > 0 else 64
+        self.buckets = [{} for _ in range(max(self.bands, 0))]
+        self.duplicates = 0
+        self._lock = threading.Lock()
+
+    def _band_values(self, dhash):
+        mask = (1 << self.band_bits) - 1
+        return [(dhash >> (band * self.band_bits)) & mask for band in range(self.bands)]
+
+    def _matches(self, dhash, colors, other_hash, other_colors):
+        return (
+            hamming_distance(dhash, other_hash) <= self.max_distance
+            and color_distance(colors, other_colors) <= self.max_color_distance
+        )
+
+    def claim(self, dhash, colors):
+        """
+        Returns (future, is_first). `is_first` means the caller must describe
+        the image and resolve `future` with the result (or None).
+        """
+        # Flat images (missing or blank thumbnails) all hash alike but can be
+        # entirely different assets.
+        if self.max_distance < 0 or colors is None or dhash in (None, 0, (1 << 64) - 1):
+            return Future(), True
+
+        band_values = self._band_values(dhash)
+        with self._lock:
+            for bucket, value in zip(self.buckets, band_values):
+                for other_hash, other_colors, future in bucket.get(value, ()):
+                    if self._matches(dhash, colors, other_hash, other_colors):
+                        self.duplicates += 1
+                        return future, False
+
+            future = Future()
+            for bucket, value in zip(self.buckets, band_values):
+                bucket.setdefault(value, []).append((dhash, colors, future))
+            return future, True
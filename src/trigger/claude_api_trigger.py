@@ -1,47 +1,128 @@
 # -*- coding: utf-8 -*-
 
+import os
 import time
+import random
 import base64
 import json
 import logging
 
 from P4 import P4, P4Exception
 
+from p4_connection import FSTAT_BATCH_SIZE, get_p4
+
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-p4 = P4()
-p4.connect()
+# Polling schedule for thumbnails HelixSearch hasn't generated yet, in seconds.
+THUMB_POLL_INITIAL_DELAY = float(os.environ.get("HELIX_THUMB_POLL_INITIAL_DELAY", 1))
+THUMB_POLL_MAX_DELAY = float(os.environ.get("HELIX_THUMB_POLL_MAX_DELAY", 30))
+THUMB_POLL_DEADLINE = float(os.environ.get("HELIX_THUMB_POLL_DEADLINE", 120))
 
+# Also fetch the (much larger) HelixSearch preview image for each file.
+# Only the thumbnail is sent to Bedrock, so this is off unless asked for.
+FETCH_PREVIEW = os.environ.get("HELIX_FETCH_PREVIEW", "").lower() in ("1", "true", "yes")
 
-def gather_file_attrs(depot_path: str, action: str):
-    file_attributes = p4.run("fstat", "-Oae", depot_path)
-    logger.debug(str(file_attributes))
-    hex_preview_attr = file_attributes[0].get("attr-preview")
-    hex_thumb_attr = file_attributes[0].get("attr-thumb")
 
-    if not hex_preview_attr:
-        return
+class FileRecord:
+    """
+    A changelist file with its HelixSearch images held as raw bytes. Base64
+    encodings are produced on demand rather than stored.
+    """
+
+    __slots__ = ("depot_path", "action", "thumb_bytes", "preview_bytes")
+
+    def __init__(self, depot_path, action, thumb_bytes, preview_bytes=None):
+        self.depot_path = depot_path
+        self.action = action
+        self.thumb_bytes = thumb_bytes
+        self.preview_bytes = preview_bytes
+
+    @property
+    def thumb_type(self):
+        return get_image_type(self.thumb_bytes)
+
+    @property
+    def thumb(self):
+        return base64.b64encode(self.thumb_bytes)
+
+    @property
+    def preview_type(self):
+        return get_image_type(self.preview_bytes) if self.preview_bytes else None
+
+    @property
+    def preview(self):
+        return base64.b64encode(self.preview_bytes) if self.preview_bytes else None
+
+    def to_dict(self):
+        return {
+            "depot_path": self.depot_path,
+            "action": self.action,
+            "preview": self.preview,
+            "preview_type": self.preview_type,
+            "thumb": self.thumb,
+            "thumb_type": self.thumb_type,
+        }
 
-    preview_image = bytes.fromhex(hex_preview_attr)
-    preview_image_type = get_image_type(preview_image)
-    preview_base64 = base64.b64encode(preview_image)
-
-    thumb_image = bytes.fromhex(hex_thumb_attr)
-    thumb_image_type = get_image_type(thumb_image)
-    thumb_base64 = base64.b64encode(thumb_image)
-
-    file_attr_dict = {
-        "depot_path": depot_path,
-        "action": action,
-        "preview": preview_base64,
-        "preview_type": preview_image_type,
-        "thumb": thumb_base64,
-        "thumb_type": thumb_image_type,
+
+def fetch_attrs(depot_paths: list, attribute: str):
+    """
+    Runs a single `p4 fstat` over all `depot_paths`, asking only for the
+    given attribute, and returns {depotFile: hex attribute value}.
+    """
+    if not depot_paths:
+        return {}
+
+    p4 = get_p4()
+    with p4.at_exception_level(P4.RAISE_ERRORS):
+        records = p4.run("fstat", "-Oae", "-A", attribute, *depot_paths)
+
+    return {
+        record["depotFile"]: record.get(f"attr-{attribute}")
+        for record in records
+        if isinstance(record, dict) and "depotFile" in record
     }
 
-    return file_attr_dict
+
+def gather_file_attrs(depot_files: list, changelist):
+    """
+    Yields (depot_file, FileRecord) for each (depot_file, action) pair, one
+    `p4 fstat` batch of FSTAT_BATCH_SIZE files at a time. The record is None
+    when the file has no thumbnail yet.
+    """
+    for start in range(0, len(depot_files), FSTAT_BATCH_SIZE):
+        chunk = depot_files[start : start + FSTAT_BATCH_SIZE]
+        thumbs = fetch_attrs(
+            [f"{depot_file}@{changelist}" for depot_file, _ in chunk], "thumb"
+        )
+
+        previews = {}
+        if FETCH_PREVIEW:
+            previews = fetch_attrs(
+                [f"{depot_file}@{changelist}" for depot_file, _ in chunk if thumbs.get(depot_file)],
+                "preview",
+            )
+
+        for depot_file, action in chunk:
+            yield depot_file, build_file_record(
+                f"{depot_file}@{changelist}",
+                action,
+                thumbs.pop(depot_file, None),
+                previews.pop(depot_file, None),
+            )
+
+
+def build_file_record(depot_path: str, action: str, hex_thumb_attr, hex_preview_attr=None):
+    if not hex_thumb_attr:
+        return
+
+    return FileRecord(
+        depot_path,
+        action,
+        bytes.fromhex(hex_thumb_attr),
+        bytes.fromhex(hex_preview_attr) if hex_preview_attr else None,
+    )
 
 
 def get_image_type(image_data):
@@ -67,48 +148,90 @@ def gather_changelist_attrs(description):
     return attr_dict
 
 
+def get_changelist_description(changelist):
+    description = get_p4().run_describe(changelist)
+    if not description:
+        return
+    return description[0]
+
+
 def gather_file_process_list(changelist):
-    description = p4.run_describe(changelist)
+    description = get_changelist_description(changelist)
     if not description:
         return
-    description = description[0]
     attribute_dict = gather_changelist_attrs(description)
 
-    attempts = {}
+    attribute_dict["file_list"].extend(
+        iter_ready_files(gather_changelist_files(description), changelist)
+    )
+    return attribute_dict
+
+
+def gather_changelist_files(description):
+    return [
+        (depot_file, description["action"][i])
+        for i, depot_file in enumerate(description["depotFile"])
+        if "delete" not in description["action"][i]
+    ]
+
+
+def iter_ready_files(depot_files: list, changelist, deadline=THUMB_POLL_DEADLINE):
+    """
+    Polls all pending (depot_file, action) pairs together in rounds and yields
+    each FileRecord as soon as its thumbnail is available. Rounds back off
+    exponentially with jitter, and files still without a thumbnail after
+    `deadline` seconds of polling are given up on.
+
+    Only time spent polling and sleeping counts towards the deadline. Time
+    the consumer holds the generator suspended at a `yield` (a pipeline
+    blocked on Bedrock, say) doesn't, so a slow consumer can't use up the
+    deadline before later rounds run.
+    """
+    polled = 0.0
+    delay = THUMB_POLL_INITIAL_DELAY
+    pending = list(depot_files)
+    attempts = {depot_file: 0 for depot_file, _ in pending}
     completed = []
-    failed = []
-
-    for i, depot_file in enumerate(description["depotFile"]):
-        action = description["action"][i]
-        file_result = None
-        if depot_file not in attempts:
-            attempts[depot_file] = 1
-
-        if "delete" not in action:
-            while depot_file not in completed and attempts[depot_file] < 5:
-                file_result = gather_file_attrs(f"{depot_file}@{changelist}", action)
-                if not file_result:
-                    attempts[depot_file] += 1
-                    time.sleep(3)
-                else:
-                    logger.debug("did it")
-                    completed.append(depot_file)
-                    attribute_dict["file_list"].append(file_result)
-            if not file_result:
-                failed.append(depot_file)
+
+    while pending:
+        not_ready = set()
+        started = time.monotonic()
+        for depot_file, file_result in gather_file_attrs(pending, changelist):
+            attempts[depot_file] += 1
+            if file_result:
+                completed.append(depot_file)
+                suspended = time.monotonic()
+                yield file_result
+                started += time.monotonic() - suspended
+            else:
+                not_ready.add(depot_file)
+        polled += time.monotonic() - started
+
+        pending = [_ for _ in pending if _[0] in not_ready]
+        remaining = deadline - polled
+        if not pending or remaining <= 0:
+            break
+
+        sleep = min(random.uniform(delay / 2, delay), remaining)
+        time.sleep(sleep)
+        polled += sleep
+        delay = min(delay * 2, THUMB_POLL_MAX_DELAY)
+
+    failed = [depot_file for depot_file, _ in pending]
 
     logger.info(f"Attempts {attempts}")
     logger.info(f"completed {completed}")
     logger.info(f"failed {failed}")
-    return attribute_dict
 
 
 def set_default(obj):
     """
-    Converts any set to a list type object.
+    Converts any set to a list type object and FileRecords to dicts.
     """
     if isinstance(obj, set):
         return list(obj)
+    elif isinstance(obj, FileRecord):
+        return obj.to_dict()
     elif isinstance(obj, bytes):
         return obj.decode("utf-8")
 
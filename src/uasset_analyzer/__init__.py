@@ -1,6 +1,9 @@
+import mmap
 import struct
 import binascii
-import contextlib
+import functools
+
+from .tables import NameMap, ImportTable, ExportTable, DependencyTable
 
 PACKAGE_FILE_TAG = 0x9E2A83C1
 PACKAGE_FILE_TAG_SWAPPED = 0xC1832A9E
@@ -9,84 +12,225 @@ VER_UE4_WORLD_LEVEL_INFO = 224
 VER_UE4_ADDED_CHUNKID_TO_ASSETDATA_AND_UPACKAGE = 278
 VER_UE4_CHANGED_CHUNKID_TO_BE_AN_ARRAY_OF_CHUNKIDS = 326
 VER_UE4_ENGINE_VERSION_OBJECT = 336
+VER_UE4_LOAD_FOR_EDITOR_GAME = 365
 VER_UE4_ADD_STRING_ASSET_REFERENCES_MAP = 384
 VER_UE4_PACKAGE_SUMMARY_HAS_COMPATIBLE_ENGINE_VERSION = 444
 VER_UE4_SERIALIZE_TEXT_IN_PACKAGES = 459
+VER_UE4_COOKED_ASSETS_IN_EDITOR_SUPPORT = 485
+VER_UE4_NAME_HASHES_SERIALIZED = 504
 VER_UE4_PRELOAD_DEPENDENCIES_IN_COOKED_EXPORTS = 507
+VER_UE4_TEMPLATE_INDEX_IN_COOKED_EXPORTS = 508
 VER_UE4_ADDED_SEARCHABLE_NAMES = 510
+VER_UE4_64BIT_EXPORTMAP_SERIALSIZES = 511
+VER_UE4_ADDED_SOFT_OBJECT_PATH = 514
 VER_UE4_ADDED_PACKAGE_SUMMARY_LOCALIZATION_ID = 516
 VER_UE4_ADDED_PACKAGE_OWNER = 518
 VER_UE4_NON_OUTER_PACKAGE_IMPORT = 520
 VER_UE5_NAMES_REFERENCED_FROM_EXPORT_DATA = 1001
 VER_UE5_PAYLOAD_TOC = 1002
 VER_UE5_OPTIONAL_RESOURCES = 1003
+VER_UE5_REMOVE_OBJECT_EXPORT_PACKAGE_GUID = 1005
+VER_UE5_TRACK_OBJECT_EXPORT_IS_INHERITED = 1006
 VER_UE5_ADD_SOFTOBJECTPATH_LIST = 1008
 VER_UE5_DATA_RESOURCES = 1009
+VER_UE5_SCRIPT_SERIALIZATION_OFFSET = 1010
+
+# Precompiled formats, keyed on whether the package is little endian.
+INT16 = {True: struct.Struct("<h"), False: struct.Struct(">h")}
+UINT16 = {True: struct.Struct("<H"), False: struct.Struct(">H")}
+INT32 = {True: struct.Struct("<i"), False: struct.Struct(">i")}
+UINT32 = {True: struct.Struct("<I"), False: struct.Struct(">I")}
+INT64 = {True: struct.Struct("<q"), False: struct.Struct(">q")}
+UINT64 = {True: struct.Struct("<Q"), False: struct.Struct(">Q")}
+NAME_HASHES = {True: struct.Struct("<HH"), False: struct.Struct(">HH")}
+
+
+@functools.lru_cache(maxsize=None)
+def row_struct_for(row_format):
+    return struct.Struct(row_format)
 
 
 class UassetReader:
-    def __init__(self, uasset_file):
+    """
+    Reads the package summary and tables of a .uasset.
+
+    `uasset_file` is either a path or a bytes-like object holding the package.
+    Paths are memory-mapped by default, in which case every value is unpacked
+    in place and thumbnail "Bytes" are memoryview slices into the mapping
+    rather than copies. Those slices stay valid until `close()`; call
+    `bytes()` on them to keep the data longer. Pass `use_mmap=False` to read
+    a path through a regular file object instead.
+
+    Only the header is parsed up front. Each other section (see SECTIONS) is
+    parsed the first time its attribute is accessed, which keeps the source
+    open until `close()`. Passing `fields` instead parses just the header and
+    the listed sections, then closes the source; `fields=()` reads the header
+    only.
+    """
+
+    # Section attribute -> method that parses it.
+    SECTIONS = {
+        "names": "read_names",
+        "gatherable_text_data": "read_gatherable_text_data",
+        "imports": "read_imports",
+        "exports": "read_exports",
+        "dependencies": "read_dependencies",
+        "soft_package_references": "read_soft_package_references",
+        "searchable_names": "read_searchable_names",
+        "thumbnail_table": "read_thumbnail_table",
+        "thumbnails": "read_thumbnails",
+        "asset_registry_data": "read_asset_registry_data",
+        "preload_dependencies": "read_preload_dependencies",
+        "bulk_data_start": "read_bulk_data_start",
+    }
+
+    file_obj = None
+    buffer = None
+
+    def __init__(self, uasset_file, use_mmap=True, fields=None):
         self.uasset_file = uasset_file
         self.use_little_endian = True
         self.header = {}
 
-        with contextlib.closing(open(self.uasset_file, "rb")) as self.file_obj:
+        self.position = 0
+        self._mmap = None
+
+        if isinstance(uasset_file, (bytes, bytearray, memoryview, mmap.mmap)):
+            self.buffer = memoryview(uasset_file)
+        elif use_mmap:
+            with open(self.uasset_file, "rb") as file_obj:
+                self._mmap = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+            self.buffer = memoryview(self._mmap)
+        else:
+            self.file_obj = open(self.uasset_file, "rb")
+
+        try:
             self.read_header()
-            self.read_names()
-            self.read_gatherable_text_data()
-            self.read_imports()
-            self.read_exports()
-            self.read_dependencies()
-            self.read_soft_package_references()
-            self.read_searchable_names()
-            self.read_thumbnails()
-            self.read_asset_registry_data()
-            self.read_preload_dependencies()
-            self.read_bulk_data_start()
+            for field in fields or ():
+                getattr(self, field)
+        except Exception:
+            self.close()
+            raise
+
+        if fields is not None:
+            self.close()
+
+    def __getattr__(self, name):
+        reader = self.SECTIONS.get(name)
+        if reader is None:
+            raise AttributeError(name)
+        if self.buffer is None and self.file_obj is None:
+            raise AttributeError(f"{name} was not read before the uasset was closed")
+
+        # Sections can be pulled in while another one is being parsed, so
+        # put the cursor back where it was afterwards.
+        position = self.current_index
+
+        # Sections that aren't parsed yet resolve to None.
+        setattr(self, name, None)
+        try:
+            getattr(self, reader)()
+        except Exception:
+            delattr(self, name)
+            raise
+        finally:
+            self.seek(position)
+        return self.__dict__[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.file_obj is not None:
+            self.file_obj.close()
+            self.file_obj = None
+        if self.buffer is not None:
+            self.buffer.release()
+            self.buffer = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Thumbnail slices are still referenced; the mapping is
+                # closed when they are garbage collected instead.
+                pass
+            self._mmap = None
 
     @property
     def current_index(self):
+        if self.buffer is not None:
+            return self.position
         return self.file_obj.tell()
 
+    def seek(self, offset):
+        if self.buffer is not None:
+            self.position = offset
+        else:
+            self.file_obj.seek(offset)
+
+    def read_bytes(self, size):
+        if self.buffer is not None:
+            if self.position + size > len(self.buffer):
+                raise EOFError("Unexpected end of uasset data")
+            data = self.buffer[self.position : self.position + size]
+            self.position += size
+            return data
+        return self.file_obj.read(size)
+
+    def read_struct(self, formats):
+        fmt = formats[self.use_little_endian]
+        if self.buffer is not None:
+            value = fmt.unpack_from(self.buffer, self.position)[0]
+            self.position += fmt.size
+            return value
+        return fmt.unpack(self.file_obj.read(fmt.size))[0]
+
+    def read_rows(self, row_format, count):
+        """
+        Reads `count` fixed-size rows laid out as `row_format` (struct format
+        characters without a byte order) and returns an iterator of tuples.
+        """
+        row_struct = row_struct_for(("<" if self.use_little_endian else ">") + row_format)
+        return row_struct.iter_unpack(self.read_bytes(row_struct.size * count))
+
+    def read_struct_tuple(self, formats):
+        fmt = formats[self.use_little_endian]
+        if self.buffer is not None:
+            values = fmt.unpack_from(self.buffer, self.position)
+            self.position += fmt.size
+            return values
+        return fmt.unpack(self.file_obj.read(fmt.size))
+
     def read_int16(self):
-        return struct.unpack(
-            "<h" if self.use_little_endian else ">h", self.file_obj.read(2)
-        )[0]
+        return self.read_struct(INT16)
 
     def read_uint16(self):
-        return struct.unpack(
-            "<H" if self.use_little_endian else ">H", self.file_obj.read(2)
-        )[0]
+        return self.read_struct(UINT16)
 
     def read_int32(self):
-        return struct.unpack(
-            "<i" if self.use_little_endian else ">i", self.file_obj.read(4)
-        )[0]
+        return self.read_struct(INT32)
 
     def read_uint32(self):
-        return struct.unpack(
-            "<I" if self.use_little_endian else ">I", self.file_obj.read(4)
-        )[0]
+        return self.read_struct(UINT32)
 
     def read_int64(self):
-        return struct.unpack(
-            "<q" if self.use_little_endian else ">q", self.file_obj.read(8)
-        )[0]
+        return self.read_struct(INT64)
 
     def read_uint64(self):
-        return struct.unpack(
-            "<Q" if self.use_little_endian else ">Q", self.file_obj.read(8)
-        )[0]
+        return self.read_struct(UINT64)
 
     def read_fguidString(self):
-        return binascii.hexlify(self.file_obj.read(16)).decode("utf-8").zfill(2)
+        return binascii.hexlify(self.read_bytes(16)).decode("utf-8").zfill(2)
 
     def read_fguidSlot(self):
         str1 = ""
         str2 = ""
         str3 = ""
         str4 = ""
-        bytes = self.file_obj.read(16)
+        bytes = self.read_bytes(16)
 
         for idx in range(3, -1, -1):
             str1 += "{:02x}".format(bytes[idx])
@@ -104,13 +248,12 @@ class UassetReader:
             return ""
 
         if length > 0:
-            string_bytes = self.file_obj.read(length)
-            string_bytes = string_bytes[:-1]  # remove null terminator
-        string = string_bytes.decode(
-            "utf-8"
-        )  # assuming the string is in utf-8 encoding
+            string_bytes = self.read_bytes(length)[:-1]  # remove null terminator
+            return str(string_bytes, "utf-8")  # assuming the string is in utf-8 encoding
 
-        return string
+        # Negative lengths are UTF-16 strings, counted in characters.
+        string_bytes = self.read_bytes(-length * 2)[:-2]
+        return str(string_bytes, "utf-16-le" if self.use_little_endian else "utf-16-be")
 
     def read_header(self):
         self.header = {}
@@ -136,6 +279,8 @@ class UassetReader:
         self.header["FileVersionUE4"] = self.read_int32()
         if self.header["LegacyFileVersion"] <= -8:
             self.header["FileVersionUE5"] = self.read_int32()
+        else:
+            self.header["FileVersionUE5"] = 0
 
         self.header["FileVersionLicenseeUE4"] = self.read_int32()
         if (
@@ -284,20 +429,18 @@ class UassetReader:
             self.header["DataResourceOffset"] = self.read_int32()
 
     def read_names(self):
-        self.file_obj.seek(self.header["NameOffset"])
-        self.names = [
-            {
-                "Name": self.read_fstring(),
-                "NonCasePreservingHash": self.read_uint16(),
-                "CasePreservingHash": self.read_uint16(),
-            }
-            for _ in range(self.header["NameCount"])
-        ]
+        self.seek(self.header["NameOffset"])
+        self.names = NameMap()
+        has_hashes = self.header["FileVersionUE4"] >= VER_UE4_NAME_HASHES_SERIALIZED
+        for _ in range(self.header["NameCount"]):
+            name = self.read_fstring()
+            hashes = self.read_struct_tuple(NAME_HASHES) if has_hashes else (0, 0)
+            self.names.append(name, *hashes)
 
     def read_gatherable_text_data(self):
         return
         # TODO: Not sure if anything interesting is here.
-        self.file_obj.seek(self.header["GatherableTextDataOffset"])
+        self.seek(self.header["GatherableTextDataOffset"])
         self.gatherable_text_data = []
         for _ in range(self.header["GatherableTextDataCount"]):
             text_data = {
@@ -332,57 +475,126 @@ class UassetReader:
         # TODO: Finish this method if it seems important
 
     def read_imports(self):
-        return
-        # TODO: Figure out why the indices are not being read correctly
-        self.file_obj.seek(self.header["ImportOffset"])
-        self.imports = []
-        for _ in range(self.header["ImportCount"]):
-            class_package = self.read_uint64()
-            class_name = self.read_uint64()
-            outer_index = self.read_int32()
-            object_name = self.read_uint64()
-            package_name = (
-                self.read_uint64()
-                if self.header["FileVersionUE4"] >= VER_UE4_NON_OUTER_PACKAGE_IMPORT
-                else 0
-            )
-            b_import_optional = (
-                (
-                    self.read_int32()
-                    if self.header["FileVersionUE4"] >= VER_UE5_OPTIONAL_RESOURCES
-                    else 0
-                ),
-            )
+        # FNames are serialized as a name index and a number.
+        fields = [
+            "ClassPackage",
+            "ClassPackageNumber",
+            "ClassName",
+            "ClassNameNumber",
+            "OuterIndex",
+            "ObjectName",
+            "ObjectNameNumber",
+        ]
+        if self.header["FileVersionUE4"] >= VER_UE4_NON_OUTER_PACKAGE_IMPORT:
+            fields += ["PackageName", "PackageNameNumber"]
+        if self.header["FileVersionUE5"] >= VER_UE5_OPTIONAL_RESOURCES:
+            fields += ["bImportOptional"]
 
-            self.imports.append(
-                {
-                    "ClassPackage": self.find_name(class_package),
-                    "ClassName": self.find_name(class_name),
-                    "OuterIndex": outer_index,
-                    "ObjectName": self.find_name(object_name),
-                    "PackageName": self.find_name(package_name),
-                    "bImportOptional": b_import_optional,
-                }
-            )
+        count = self.header["ImportCount"]
+        self.seek(self.header["ImportOffset"])
+        self.imports = ImportTable.from_rows(
+            self.names, fields, self.read_rows("i" * len(fields), count), count
+        )
 
     def read_exports(self):
-        pass
+        ue4_version = self.header["FileVersionUE4"]
+        ue5_version = self.header["FileVersionUE5"]
+
+        fields = ["ClassIndex", "SuperIndex"]
+        row_format = "ii"
+        if ue4_version >= VER_UE4_TEMPLATE_INDEX_IN_COOKED_EXPORTS:
+            fields += ["TemplateIndex"]
+            row_format += "i"
+        fields += ["OuterIndex", "ObjectName", "ObjectNameNumber", "ObjectFlags"]
+        row_format += "iiiI"
+        fields += ["SerialSize", "SerialOffset"]
+        row_format += "qq" if ue4_version >= VER_UE4_64BIT_EXPORTMAP_SERIALSIZES else "ii"
+        fields += ["bForcedExport", "bNotForClient", "bNotForServer"]
+        row_format += "iii"
+        if ue5_version < VER_UE5_REMOVE_OBJECT_EXPORT_PACKAGE_GUID:
+            fields += [None]  # PackageGuid
+            row_format += "16s"
+        if ue5_version >= VER_UE5_TRACK_OBJECT_EXPORT_IS_INHERITED:
+            fields += ["bIsInheritedInstance"]
+            row_format += "i"
+        fields += ["PackageFlags"]
+        row_format += "I"
+        if ue4_version >= VER_UE4_LOAD_FOR_EDITOR_GAME:
+            fields += ["bNotAlwaysLoadedForEditorGame"]
+            row_format += "i"
+        if ue4_version >= VER_UE4_COOKED_ASSETS_IN_EDITOR_SUPPORT:
+            fields += ["bIsAsset"]
+            row_format += "i"
+        if ue5_version >= VER_UE5_OPTIONAL_RESOURCES:
+            fields += ["bGeneratePublicHash"]
+            row_format += "i"
+        if ue4_version >= VER_UE4_PRELOAD_DEPENDENCIES_IN_COOKED_EXPORTS:
+            fields += [
+                "FirstExportDependency",
+                "SerializationBeforeSerializationDependencies",
+                "CreateBeforeSerializationDependencies",
+                "SerializationBeforeCreateDependencies",
+                "CreateBeforeCreateDependencies",
+            ]
+            row_format += "iiiii"
+        if ue5_version >= VER_UE5_SCRIPT_SERIALIZATION_OFFSET:
+            fields += ["ScriptSerializationStartOffset", "ScriptSerializationEndOffset"]
+            row_format += "qq"
+
+        count = self.header["ExportCount"]
+        self.seek(self.header["ExportOffset"])
+        self.exports = ExportTable.from_rows(
+            self.names, fields, self.read_rows(row_format, count), count
+        )
 
     def read_dependencies(self):
-        pass
+        self.dependencies = DependencyTable()
+        if self.header["DependsOffset"] <= 0:
+            return
+
+        self.seek(self.header["DependsOffset"])
+        for _ in range(self.header["ExportCount"]):
+            count = self.read_int32()
+            # Read the whole list as a single row of `count` package indexes.
+            self.dependencies.append(next(self.read_rows(f"{count}i", 1)) if count else ())
 
     def read_soft_package_references(self):
-        pass
+        self.soft_package_references = []
+        if (
+            self.header["FileVersionUE4"] < VER_UE4_ADD_STRING_ASSET_REFERENCES_MAP
+            or self.header["SoftPackageReferencesOffset"] <= 0
+        ):
+            return
+
+        self.seek(self.header["SoftPackageReferencesOffset"])
+        count = self.header["SoftPackageReferencesCount"]
+        if self.header["FileVersionUE4"] < VER_UE4_ADDED_SOFT_OBJECT_PATH:
+            self.soft_package_references = [self.read_fstring() for _ in range(count)]
+        else:
+            self.soft_package_references = [
+                self.names.resolve(index, number)
+                for index, number in self.read_rows("ii", count)
+            ]
+
+    def package_dependencies(self):
+        """
+        Returns the packages this package references: the packages it
+        imports from followed by its soft package references.
+        """
+        packages = dict.fromkeys(self.imports.package_names())
+        packages.update(dict.fromkeys(self.soft_package_references))
+        packages.pop(None, None)
+        return list(packages)
 
     def read_searchable_names(self):
         pass
 
-    def read_thumbnails(self):
-        self.file_obj.seek(self.header["ThumbnailTableOffset"])
+    def read_thumbnail_table(self):
+        self.seek(self.header["ThumbnailTableOffset"])
         thumbnail_count = self.read_int32()
-        self.thumbnails = []
+        self.thumbnail_table = []
         for _ in range(thumbnail_count):
-            self.thumbnails.append(
+            self.thumbnail_table.append(
                 {
                     "AssetClassName": self.read_fstring(),
                     "ObjectPathWithoutPackageName": self.read_fstring(),
@@ -390,15 +602,18 @@ class UassetReader:
                 }
             )
 
+    def read_thumbnails(self):
+        self.thumbnails = [dict(thumbnail) for thumbnail in self.thumbnail_table]
+
         for thumbnail in self.thumbnails:
-            self.file_obj.seek(thumbnail["FileOffset"])
+            self.seek(thumbnail["FileOffset"])
             thumbnail["Width"] = self.read_int32()
             thumbnail["Height"] = self.read_int32()
             thumbnail["Format"] = "JPEG" if thumbnail["Height"] < 0 else "PNG"
             thumbnail["Height"] = abs(thumbnail["Height"])
             thumbnail["Size"] = self.read_int32()
             thumbnail["Bytes"] = (
-                self.file_obj.read(thumbnail["Size"]) if thumbnail["Size"] > 0 else None
+                self.read_bytes(thumbnail["Size"]) if thumbnail["Size"] > 0 else None
             )
 
     def read_asset_registry_data(self):
@@ -410,8 +625,19 @@ class UassetReader:
     def read_bulk_data_start(self):
         pass
 
-    def find_name(self, index):
-        return self.names[index]["Name"]
+    def find_name(self, index, number=0):
+        return self.names.resolve(index, number)
+
+
+def read_total_header_size(data):
+    """
+    Returns the package's TotalHeaderSize from the start of a .uasset, or
+    None if `data` is too short to hold the whole package summary yet.
+    """
+    try:
+        return UassetReader(data, fields=()).header["TotalHeaderSize"]
+    except (struct.error, EOFError):
+        return None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+import time
+
+import sqlite_store
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+DEFAULT_CACHE_PATH = sqlite_store.DEFAULT_DIRECTORY / "uasset_analysis_cache.sqlite3"
+
+# Set UASSET_ANALYSIS_CACHE_PATH to an empty string to disable the cache.
+CACHE_PATH = os.environ.get("UASSET_ANALYSIS_CACHE_PATH", str(DEFAULT_CACHE_PATH))
+CACHE_MAX_ENTRIES = int(os.environ.get("UASSET_ANALYSIS_CACHE_MAX_ENTRIES", 200000))
+
+# Bump when analysis results change shape so older entries stop matching.
+ANALYSIS_VERSION = 1
+
+
+class AnalysisCache(sqlite_store.SqliteCache):
+    """
+    Persistent store of uasset analysis results keyed on the Perforce content
+    digest and size, so identical content on any path or branch is only
+    fetched and parsed once. Least recently used entries are evicted past
+    `max_entries`.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS analyses (
+            key TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            last_used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS analyses_last_used ON analyses (last_used);
+    """
+
+    def __init__(self, path, max_entries=CACHE_MAX_ENTRIES):
+        super().__init__(path)
+        self.max_entries = max_entries
+
+    @staticmethod
+    def make_key(digest, file_size):
+        return f"{ANALYSIS_VERSION}:{digest}:{file_size}"
+
+    def get(self, key):
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT result FROM analyses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self.connection.execute(
+                    "UPDATE analyses SET last_used = ? WHERE key = ?", (time.time(), key)
+                )
+                self.connection.commit()
+
+        self.count_lookup(row is not None)
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, key, result):
+        cached_result = {k: v for k, v in result.items() if k != "depot_path"}
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO analyses (key, result, last_used) VALUES (?, ?, ?)",
+                (key, json.dumps(cached_result), time.time()),
+            )
+            self.connection.commit()
+
+    def evict(self):
+        with self._lock:
+            evicted = self.connection.execute(
+                """
+                DELETE FROM analyses WHERE key IN (
+                    SELECT key FROM analyses ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            ).rowcount
+            self.connection.commit()
+
+        if evicted:
+            logger.info(f"Evicted {evicted} least recently used uasset analyses")
+
+
+def from_environment():
+    return sqlite_store.open_store(AnalysisCache, CACHE_PATH)
@@ -0,0 +1,224 @@
+import os
+import re
+
+import sqlite_store
+
+
+DEFAULT_INDEX_PATH = sqlite_store.DEFAULT_DIRECTORY / "dependency_index.sqlite3"
+
+# Set UASSET_DEPENDENCY_INDEX_PATH to an empty string to disable the index.
+INDEX_PATH = os.environ.get("UASSET_DEPENDENCY_INDEX_PATH", str(DEFAULT_INDEX_PATH))
+
+CONTENT_DIR = re.compile(r"/content/", re.IGNORECASE)
+
+
+def package_from_depot_path(depot_path):
+    """
+    Maps a depot path to (root, package name): the project directory holding
+    the Content directory, and the Unreal package name other assets import
+    it by. For example //proj/main/Game/Content/Textures/T_Brick.uasset maps
+    to ("//proj/main/Game", "/Game/Textures/T_Brick"), and
+    //proj/main/Game/Plugins/Foo/Content/Bar.uasset to ("//proj/main/Game",
+    "/Foo/Bar"). Returns None for files outside a Content directory.
+
+    The same package name exists once per branch or stream, and imports
+    resolve within the importing package's own project, so packages are
+    keyed on both.
+    """
+    depot_path = depot_path.split("@")[0]
+    matches = list(CONTENT_DIR.finditer(depot_path))
+    if not matches:
+        return None
+
+    content_dir = matches[-1]
+    root = depot_path[: content_dir.start()]
+    relative_path = depot_path[content_dir.end() :].rsplit(".", 1)[0]
+
+    parts = root.split("/")
+    mount = "Game"
+    if len(parts) >= 2 and parts[-2].lower() == "plugins":
+        mount = parts[-1]
+        root = "/".join(parts[:-2])
+
+    return root, f"/{mount}/{relative_path}"
+
+
+class DependencyIndex(sqlite_store.SqliteStore):
+    """
+    Persistent package -> package reference graph built from uasset import
+    tables, answering "what references this package?" without reparsing.
+    Packages are identified by (root, package name), see
+    package_from_depot_path, and a package's references resolve within its
+    own root, so each branch or stream has a graph of its own. Roots and
+    package names compare case-insensitively, as they do in Perforce and
+    Unreal.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS packages (
+            id INTEGER PRIMARY KEY,
+            root TEXT NOT NULL COLLATE NOCASE,
+            name TEXT NOT NULL COLLATE NOCASE,
+            depot_path TEXT,
+            UNIQUE (root, name)
+        );
+        CREATE TABLE IF NOT EXISTS package_references (
+            source_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            PRIMARY KEY (source_id, target_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS package_references_target
+            ON package_references (target_id, source_id);
+    """
+
+    def _package_id(self, root, name):
+        self.connection.execute(
+            "INSERT OR IGNORE INTO packages (root, name) VALUES (?, ?)", (root, name)
+        )
+        return self.connection.execute(
+            "SELECT id FROM packages WHERE root = ? AND name = ?", (root, name)
+        ).fetchone()[0]
+
+    def update_package(self, root, name, depot_path, dependencies):
+        """
+        Replaces the recorded references of `name` under `root` with
+        `dependencies`, which resolve under the same root, and returns the
+        dependencies it had before.
+        """
+        with self._lock, self.connection:
+            source_id = self._package_id(root, name)
+            self.connection.execute(
+                "UPDATE packages SET depot_path = ? WHERE id = ?", (depot_path, source_id)
+            )
+            previous = self._dependencies_of(source_id)
+            self.connection.execute(
+                "DELETE FROM package_references WHERE source_id = ?", (source_id,)
+            )
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO package_references (source_id, target_id) VALUES (?, ?)",
+                [
+                    (source_id, self._package_id(root, dependency))
+                    for dependency in dependencies
+                    if dependency.lower() != name.lower()
+                ],
+            )
+        return previous
+
+    def remove_package(self, root, name):
+        """
+        Forgets the references made by a deleted package and returns them.
+        References to it from other packages are kept.
+        """
+        with self._lock, self.connection:
+            row = self.connection.execute(
+                "SELECT id FROM packages WHERE root = ? AND name = ?", (root, name)
+            ).fetchone()
+            if row is None:
+                return []
+            previous = self._dependencies_of(row[0])
+            self.connection.execute(
+                "DELETE FROM package_references WHERE source_id = ?", (row[0],)
+            )
+            self.connection.execute(
+                "UPDATE packages SET depot_path = NULL WHERE id = ?", (row[0],)
+            )
+        return previous
+
+    def _dependencies_of(self, source_id):
+        return [
+            row[0]
+            for row in self.connection.execute(
+                """
+                SELECT packages.name FROM package_references
+                JOIN packages ON packages.id = package_references.target_id
+                WHERE package_references.source_id = ?
+                """,
+                (source_id,),
+            )
+        ]
+
+    def depot_path(self, root, name):
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT depot_path FROM packages WHERE root = ? AND name = ?", (root, name)
+            ).fetchone()
+        return row[0] if row else None
+
+    def dependencies(self, root, name):
+        with self._lock:
+            return [
+                row[0]
+                for row in self.connection.execute(
+                    """
+                    SELECT target.name FROM packages AS source
+                    JOIN package_references ON package_references.source_id = source.id
+                    JOIN packages AS target ON target.id = package_references.target_id
+                    WHERE source.root = ? AND source.name = ?
+                    """,
+                    (root, name),
+                )
+            ]
+
+    def referencers(self, root, name):
+        with self._lock:
+            return [
+                row[0]
+                for row in self.connection.execute(
+                    """
+                    SELECT source.name FROM packages AS target
+                    JOIN package_references ON package_references.target_id = target.id
+                    JOIN packages AS source ON source.id = package_references.source_id
+                    WHERE target.root = ? AND target.name = ?
+                    """,
+                    (root, name),
+                )
+            ]
+
+    def referencer_count(self, root, name):
+        with self._lock:
+            return self.connection.execute(
+                """
+                SELECT COUNT(*) FROM packages AS target
+                JOIN package_references ON package_references.target_id = target.id
+                WHERE target.root = ? AND target.name = ?
+                """,
+                (root, name),
+            ).fetchone()[0]
+
+    def transitive_referencers(self, root, name):
+        """
+        Returns every package under `root` that references `name` directly
+        or through other packages.
+        """
+        return self._closure(root, name, "target_id", "source_id")
+
+    def transitive_dependencies(self, root, name):
+        """
+        Returns every package under `root` that `name` depends on directly
+        or through other packages.
+        """
+        return self._closure(root, name, "source_id", "target_id")
+
+    def _closure(self, root, name, from_column, to_column):
+        with self._lock:
+            return [
+                row[0]
+                for row in self.connection.execute(
+                    f"""
+                    WITH RECURSIVE reachable(id) AS (
+                        SELECT id FROM packages WHERE root = ? AND name = ?
+                        UNION
+                        SELECT package_references.{to_column} FROM package_references
+                        JOIN reachable ON package_references.{from_column} = reachable.id
+                    )
+                    SELECT packages.name FROM reachable
+                    JOIN packages ON packages.id = reachable.id
+                    WHERE packages.name != ?
+                    """,
+                    (root, name, name),
+                )
+            ]
+
+
+def from_environment():
+    return sqlite_store.open_store(DependencyIndex, INDEX_PATH)
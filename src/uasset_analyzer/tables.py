@@ -0,0 +1,207 @@
+import sys
+from array import array
+
+
+class NameMap:
+    """
+    The package name table, held as interned strings with the two name
+    hashes in parallel uint16 arrays. Packages saved before the hashes were
+    serialized get zeros.
+    """
+
+    __slots__ = ("names", "non_case_preserving_hashes", "case_preserving_hashes")
+
+    def __init__(self):
+        self.names = []
+        self.non_case_preserving_hashes = array("H")
+        self.case_preserving_hashes = array("H")
+
+    def append(self, name, non_case_preserving_hash, case_preserving_hash):
+        self.names.append(sys.intern(name))
+        self.non_case_preserving_hashes.append(non_case_preserving_hash)
+        self.case_preserving_hashes.append(case_preserving_hash)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        return self.names[index]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def resolve(self, index, number=0):
+        """
+        Returns the string for an FName stored as (name index, number).
+        """
+        if index < 0 or index >= len(self.names):
+            return None
+        if number:
+            return f"{self.names[index]}_{number - 1}"
+        return self.names[index]
+
+
+class Table:
+    """
+    A package table stored column by column in typed arrays rather than as a
+    dict per row. FName fields are kept as a name index column plus a
+    "<field>Number" column and resolved against the name map on row access.
+    """
+
+    # field -> array typecode, for every column the table can hold
+    COLUMNS = {}
+    NAME_FIELDS = ()
+
+    def __init__(self, names, columns, count):
+        self.names = names
+        self.columns = columns
+        self.count = count
+
+    @classmethod
+    def from_rows(cls, names, fields, rows, count):
+        """
+        Builds the table from unpacked row tuples. `fields` names each value
+        in a row, with None for values that aren't kept. Columns the package
+        version doesn't serialize are filled with zeros.
+        """
+        values_by_column = zip(*rows) if count else [() for _ in fields]
+
+        columns = {}
+        for field, values in zip(fields, values_by_column):
+            if field:
+                columns[field] = array(cls.COLUMNS[field], values)
+
+        for field, typecode in cls.COLUMNS.items():
+            if field not in columns:
+                columns[field] = array(typecode, [0]) * count
+
+        return cls(names, columns, count)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+
+        row = {}
+        for field, column in self.columns.items():
+            if field.endswith("Number") and field[: -len("Number")] in self.NAME_FIELDS:
+                continue
+            if field in self.NAME_FIELDS:
+                row[field] = self.names.resolve(
+                    column[index], self.columns[f"{field}Number"][index]
+                )
+            else:
+                row[field] = column[index]
+        return row
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+    def column(self, field):
+        return self.columns[field]
+
+    def resolve_column(self, field):
+        """
+        Returns the strings of an FName column, one per row.
+        """
+        numbers = self.columns[f"{field}Number"]
+        return [
+            self.names.resolve(index, number)
+            for index, number in zip(self.columns[field], numbers)
+        ]
+
+
+class ImportTable(Table):
+    COLUMNS = {
+        "ClassPackage": "i",
+        "ClassPackageNumber": "i",
+        "ClassName": "i",
+        "ClassNameNumber": "i",
+        "OuterIndex": "i",
+        "ObjectName": "i",
+        "ObjectNameNumber": "i",
+        "PackageName": "i",
+        "PackageNameNumber": "i",
+        "bImportOptional": "b",
+    }
+    NAME_FIELDS = ("ClassPackage", "ClassName", "ObjectName", "PackageName")
+
+    def package_names(self):
+        """
+        Returns the names of the packages this package imports from, in
+        import order and without duplicates.
+        """
+        class_names = self.columns["ClassName"]
+        outer_indexes = self.columns["OuterIndex"]
+        object_names = self.resolve_column("ObjectName")
+
+        packages = {}
+        for index in range(self.count):
+            if outer_indexes[index] == 0 and self.names.resolve(class_names[index]) == "Package":
+                packages[object_names[index]] = None
+        return list(packages)
+
+
+class ExportTable(Table):
+    COLUMNS = {
+        "ClassIndex": "i",
+        "SuperIndex": "i",
+        "TemplateIndex": "i",
+        "OuterIndex": "i",
+        "ObjectName": "i",
+        "ObjectNameNumber": "i",
+        "ObjectFlags": "I",
+        "SerialSize": "q",
+        "SerialOffset": "q",
+        "bForcedExport": "b",
+        "bNotForClient": "b",
+        "bNotForServer": "b",
+        "bIsInheritedInstance": "b",
+        "PackageFlags": "I",
+        "bNotAlwaysLoadedForEditorGame": "b",
+        "bIsAsset": "b",
+        "bGeneratePublicHash": "b",
+        "FirstExportDependency": "i",
+        "SerializationBeforeSerializationDependencies": "i",
+        "CreateBeforeSerializationDependencies": "i",
+        "SerializationBeforeCreateDependencies": "i",
+        "CreateBeforeCreateDependencies": "i",
+        "ScriptSerializationStartOffset": "q",
+        "ScriptSerializationEndOffset": "q",
+    }
+    NAME_FIELDS = ("ObjectName",)
+
+
+class DependencyTable:
+    """
+    The per-export dependency lists of a package, flattened into one array of
+    package indexes with an offsets array marking where each export's list
+    starts.
+    """
+
+    __slots__ = ("offsets", "indexes")
+
+    def __init__(self):
+        self.offsets = array("i", [0])
+        self.indexes = array("i")
+
+    def append(self, package_indexes):
+        self.indexes.extend(package_indexes)
+        self.offsets.append(len(self.indexes))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, export_index):
+        if not 0 <= export_index < len(self):
+            raise IndexError(export_index)
+        return self.indexes[self.offsets[export_index] : self.offsets[export_index + 1]].tolist()
+
+    def __iter__(self):
+        for export_index in range(len(self)):
+            yield self[export_index]
@@ -1,53 +1,135 @@
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import os
+import queue
+import collections
 import logging
 import argparse
 import tempfile
+import threading
+import contextlib
+import multiprocessing
 
 import environment
+import worker_service
+from p4_connection import FSTAT_BATCH_SIZE, get_p4
 
-from P4 import P4, P4Exception
+from P4 import P4, P4Exception, OutputHandler
 
-from uasset_analyzer import UassetReader
-from dam_api.write_metadata import attach_metadata
+from uasset_analyzer import (
+    UassetReader,
+    read_total_header_size,
+    analysis_cache,
+    dependency_index,
+)
 
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-p4 = P4()
-p4.connect()
+# Stream only the package header out of `p4 print` instead of writing the
+# whole file to a temp dir. Set to false to fall back to full downloads.
+PARTIAL_FETCH = os.environ.get("UASSET_PARTIAL_FETCH", "true").lower() in ("1", "true", "yes")
 
+# Parser processes for analyze_files. 1 keeps everything on the main process
+# and the global P4 connection.
+ANALYZE_WORKERS = int(os.environ.get("UASSET_ANALYZE_WORKERS", 1))
 
-def main(changelist):
+# P4 connections used to fetch files when analyzing in parallel.
+FETCH_CONNECTIONS = int(os.environ.get("UASSET_FETCH_CONNECTIONS", 4))
+# Fetched files (and files waiting to be parsed) held in memory at once when
+# analyzing in parallel.
+MAX_FETCHES_IN_FLIGHT = int(
+    os.environ.get("UASSET_MAX_FETCHES_IN_FLIGHT", FETCH_CONNECTIONS * 2)
+)
+
+# Read each asset's import table so the dependency index can be kept up to date.
+TRACK_DEPENDENCIES = bool(dependency_index.INDEX_PATH)
+
+
+def main(changelist, partial=PARTIAL_FETCH, workers=ANALYZE_WORKERS):
     description = get_changelist_description(changelist)
     if not description:
         return
     files = filter_files(description)
-    if not files:
+    deleted_files = filter_files(description, deleted=True)
+    if not files and not deleted_files:
         return
 
+    # Imported here so changelists without uassets exit before loading requests.
+    from dam_api.write_metadata import BatchWriter, get_client
+
     logger.info(f"Analyzing {len(files)} files")
-    results = analyze_files(files, changelist)
+    results = analyze_files(files, changelist, partial, workers) if files else []
     logger.info(results)
 
+    # The client outlives the changelist; only its latencies are per changelist.
+    dam_client = get_client()
+    dam_client.reset_latency_stats()
+    writer = BatchWriter(dam_client)
     for result in results:
         if result["uasset_type"]:
-            attach_metadata(result["depot_path"], "uasset type", result["uasset_type"])
+            writer.add_metadata(
+                result["depot_path"], "uasset type", result["uasset_type"]
+            )
         if result["saved_by_version"]:
-            attach_metadata(
+            writer.add_metadata(
                 result["depot_path"], "saved by UE version", result["saved_by_version"]
             )
         if result["compatible_with_version"]:
-            attach_metadata(
+            writer.add_metadata(
                 result["depot_path"],
                 "compatible with UE version",
                 result["compatible_with_version"],
             )
+    if TRACK_DEPENDENCIES:
+        update_dependency_index(results, deleted_files, writer)
+    writer.flush()
+    logger.info(f"DAM latency: {dam_client.latency_stats()}")
+
+
+def update_dependency_index(results, deleted_files, writer):
+    """
+    Records the references of every analyzed asset, forgets those of deleted
+    ones, and refreshes the "referenced by" count of each indexed asset whose
+    referencers may have changed. Packages are tracked per branch root, so
+    the same asset in another branch or stream keeps its own count.
+    """
+    index = dependency_index.from_environment()
+    affected = set()
+
+    for result in results:
+        if result["dependencies"] is None:
+            continue
+        depot_path = result["depot_path"].split("@")[0]
+        package = dependency_index.package_from_depot_path(depot_path)
+        if not package:
+            continue
+        root, package_name = package
+        previous = index.update_package(root, package_name, depot_path, result["dependencies"])
+        affected.add(package)
+        affected.update((root, name) for name in previous)
+        affected.update((root, name) for name in result["dependencies"])
+
+    for depot_path in deleted_files:
+        package = dependency_index.package_from_depot_path(depot_path)
+        if package:
+            root, package_name = package
+            affected.update((root, name) for name in index.remove_package(root, package_name))
+
+    for root, package_name in affected:
+        depot_path = index.depot_path(root, package_name)
+        if depot_path:
+            writer.add_metadata(
+                depot_path, "referenced by", str(index.referencer_count(root, package_name))
+            )
+
+    index.close()
 
 
 def get_changelist_description(changelist):
     try:
-        description = p4.run("describe", "-s", changelist)[0]
+        description = get_p4().run("describe", "-s", changelist)[0]
     except P4Exception as e:
         logger.error(f"Failed to get changelist description: {e}")
         return None
@@ -55,59 +137,358 @@ def get_changelist_description(changelist):
     return description
 
 
-def filter_files(description):
+def filter_files(description, deleted=False):
     file_list = []
     for i, depot_file in enumerate(description["depotFile"]):
         # Skip files that are not uasset or are ExternalActors or ExternalObjects
         if not depot_file.endswith(".uasset") or "__External" in depot_file:
             continue
         action = description["action"][i]
-        if "delete" in action:
+        if ("delete" in action) != deleted:
             continue
         file_list.append(f"{depot_file}")
 
     return file_list
 
 
-def analyze_files(files, changelist):
-    results = []
+class P4Pool:
+    """
+    Hands out up to `size` P4 connections to fetch threads, connecting them
+    on first use and reusing them after. A connection that was dropped while
+    idle, as a cancelled `p4 print` does, is reconnected before it's handed
+    out again; `connects` counts how often that happened.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.connections = []
+        self.connects = 0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        try:
+            connection = self.idle.get_nowait()
+        except queue.Empty:
+            connection = None
+            with self.lock:
+                if len(self.connections) < self.size:
+                    connection = P4()
+                    self.connections.append(connection)
+            if connection is None:
+                connection = self.idle.get()
+
+        try:
+            if not connection.connected():
+                connection.connect()
+                with self.lock:
+                    self.connects += 1
+            yield connection
+        finally:
+            self.idle.put(connection)
+
+    def close(self):
+        for connection in self.connections:
+            if connection.connected():
+                connection.disconnect()
+        self.connections = []
+
+
+class HeaderCollector(OutputHandler):
+    """
+    Collects `p4 print` output in memory and cancels the transfer as soon as
+    the package header (everything up to TotalHeaderSize) has arrived.
+
+    The P4 API ends a cancelled command by dropping the connection, so every
+    partial fetch costs a reconnect on the next one. That is usually far
+    cheaper than transferring the rest of the file, but for changelists of
+    small assets on a high-latency server UASSET_PARTIAL_FETCH=false can
+    come out ahead; the reconnect count is logged after each run to compare.
+    """
+
+    def __init__(self):
+        OutputHandler.__init__(self)
+        self.data = bytearray()
+        self.header_size = None
+        self.error = None
+
+    def outputStat(self, stat):
+        return OutputHandler.HANDLED
+
+    def outputText(self, text):
+        if isinstance(text, str):
+            text = text.encode("utf-8")
+        return self.collect(text)
+
+    def outputBinary(self, data):
+        return self.collect(data)
+
+    def collect(self, data):
+        self.data.extend(data)
+
+        if self.header_size is None:
+            try:
+                self.header_size = read_total_header_size(self.data)
+            except Exception as err:
+                self.error = err
+                return OutputHandler.CANCEL
+
+        if self.header_size is not None and len(self.data) >= self.header_size:
+            return OutputHandler.CANCEL
+        return OutputHandler.HANDLED
+
+
+def fetch_header_bytes(depot_path, connection=None):
+    collector = HeaderCollector()
+    (connection or get_p4()).run("print", depot_path, handler=collector)
+    if collector.error:
+        raise collector.error
+    return collector.data
+
+
+def download_file(depot_path, temp_path, connection=None):
+    local_path = Path(temp_path) / Path(*Path(depot_path.split("@")[0]).parts[1:])
+    (connection or get_p4()).run("print", "-o", local_path, depot_path)
+    return local_path
+
+
+def fetch_uasset(depot_path, partial, temp_path, connection=None):
+    """
+    Returns something UassetReader can read for the revision: its header
+    bytes when fetching partially, otherwise the path it was downloaded to.
+    """
+    if partial:
+        return fetch_header_bytes(depot_path, connection)
+    return download_file(depot_path, temp_path, connection)
+
+
+def fetch_digests(revisions):
+    """
+    Returns {revision: (digest, file size)} for the given revisions, using
+    one `p4 fstat -Ol` per FSTAT_BATCH_SIZE files.
+    """
+    by_depot_file = {revision.split("@")[0]: revision for revision in revisions}
+    digests = {}
+    for start in range(0, len(revisions), FSTAT_BATCH_SIZE):
+        chunk = revisions[start : start + FSTAT_BATCH_SIZE]
+        p4 = get_p4()
+        with p4.at_exception_level(P4.RAISE_ERRORS):
+            records = p4.run("fstat", "-Ol", *chunk)
+        for record in records:
+            if not isinstance(record, dict) or not record.get("digest"):
+                continue
+            revision = by_depot_file.get(record.get("depotFile"))
+            if revision:
+                digests[revision] = (record["digest"], record.get("fileSize"))
+    return digests
+
+
+def analyze_files(files, changelist, partial=PARTIAL_FETCH, workers=ANALYZE_WORKERS):
+    """
+    Analyzes each file at the changelist, keeping the order of `files`.
+    Content already analyzed under any path (same Perforce digest) is served
+    from the analysis cache, and identical content within the changelist is
+    only fetched and parsed once.
+    """
+    revisions = [f"{depot_path}@{changelist}" for depot_path in files]
+
+    cache = analysis_cache.from_environment()
+    if not cache:
+        return analyze_revisions(revisions, partial, workers)
+
+    try:
+        digests = fetch_digests(revisions)
+    except P4Exception as err:
+        logger.error(f"Failed to fetch digests: {err}")
+        digests = {}
+
+    keys = {
+        revision: cache.make_key(*digests[revision])
+        for revision in revisions
+        if revision in digests
+    }
+    cacheable = set(keys.values())
+
+    results = {}
+    to_analyze = {}  # cache key (or revision when unknown) -> first revision with it
+    for revision in revisions:
+        key = keys.get(revision, revision)
+        if key in to_analyze or key in results:
+            continue
+        cached = cache.get(key) if revision in keys else None
+        if cached and (cached["dependencies"] is not None or not TRACK_DEPENDENCIES):
+            results[key] = cached
+        else:
+            to_analyze[key] = revision
+
+    analyzed = analyze_revisions(list(to_analyze.values()), partial, workers)
+    for key, result in zip(to_analyze, analyzed):
+        results[key] = result
+        if key in cacheable and result["saved_by_version"]:
+            cache.put(key, result)
+
+    cache.evict()
+    logger.info(f"Analysis cache: {cache.stats()}")
+    cache.close()
+
+    return [
+        dict(results[keys.get(revision, revision)], depot_path=revision)
+        for revision in revisions
+    ]
+
+
+def analyze_revisions(revisions, partial, workers):
     with tempfile.TemporaryDirectory() as temp_dir:
-        temp_path = Path(temp_dir)
-        for depot_path in files:
-            path = Path(depot_path)
-            sub_path = Path(*path.parts[1:])
-            p4.run("print", "-o", temp_path / sub_path, f"{depot_path}@{changelist}")
-            uasset_type = None
-            saved_by_version = None
-            compatible_with_version = None
+        if workers > 1:
+            return analyze_revisions_parallel(revisions, partial, temp_dir, workers)
+
+        # A single pooled connection, so a partial fetch's dropped connection
+        # is picked up again the same way as in the parallel path.
+        pool = P4Pool(1)
+        results = []
+        for revision in revisions:
             try:
-                uasset = UassetReader(temp_path / sub_path)
+                with pool.connection() as connection:
+                    source = fetch_uasset(revision, partial, temp_dir, connection)
+            except Exception as err:
+                logger.error(f"Failed to fetch {revision}: {err}")
+                source = None
+            results.append(analyze_uasset(revision, source))
+
+        logger.info(f"P4 connects for {len(revisions)} fetches: {pool.connects}")
+        pool.close()
+        return results
+
+
+def analyze_revisions_parallel(revisions, partial, temp_dir, workers):
+    """
+    Fetches revisions over a pool of FETCH_CONNECTIONS P4 connections and
+    parses them on `workers` processes. Results keep the order of
+    `revisions`, and a file that fails to fetch or parse gets an empty result.
+
+    At most MAX_FETCHES_IN_FLIGHT fetches and as many parses are outstanding
+    at once, so only that many fetched buffers are held in memory however
+    large the changelist.
+    """
+    pool = P4Pool(FETCH_CONNECTIONS)
+
+    def fetch(revision):
+        with pool.connection() as connection:
+            return fetch_uasset(revision, partial, temp_dir, connection)
+
+    fetches = collections.deque()
+    parses = collections.deque()
+    results = []
+
+    def collect_parse():
+        revision, parsed = parses.popleft()
+        try:
+            results.append(parsed.result())
+        except Exception as err:
+            logger.error(f"Failed to analyze {revision}: {err}")
+            results.append(analyze_uasset(revision, None))
+
+    def collect_fetch():
+        revision, fetched = fetches.popleft()
+        try:
+            source = fetched.result()
+        except Exception as err:
+            logger.error(f"Failed to fetch {revision}: {err}")
+            source = None
+        parses.append((revision, parsers.submit(analyze_uasset, revision, source)))
+        if len(parses) >= MAX_FETCHES_IN_FLIGHT:
+            collect_parse()
+
+    # Parser processes are spawned rather than forked, since the fetch
+    # threads are already running when they start.
+    with ThreadPoolExecutor(pool.size, thread_name_prefix="p4-fetch") as fetchers, ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn")
+    ) as parsers:
+        for revision in revisions:
+            fetches.append((revision, fetchers.submit(fetch, revision)))
+            if len(fetches) >= MAX_FETCHES_IN_FLIGHT:
+                collect_fetch()
+        while fetches:
+            collect_fetch()
+        while parses:
+            collect_parse()
+
+    logger.info(f"P4 connects for {len(revisions)} fetches: {pool.connects}")
+    pool.close()
+    return results
+
+
+def analyze_uasset(depot_path, source):
+    """
+    Reads the asset type, engine versions and, when TRACK_DEPENDENCIES is on,
+    referenced packages from a .uasset given as a local path or as a buffer
+    holding at least its package header.
+    """
+    uasset_type = None
+    saved_by_version = None
+    compatible_with_version = None
+    dependencies = None
+    if source is not None:
+        try:
+            # Sections are parsed on access, so only the header, the thumbnail
+            # table and, if needed, the import tables are read.
+            with UassetReader(source) as uasset:
                 uasset_type = (
-                    uasset.thumbnails[0].get("AssetClassName", None)
-                    if uasset.thumbnails
+                    uasset.thumbnail_table[0].get("AssetClassName", None)
+                    if uasset.thumbnail_table
                     else None
                 )
                 saved_by_version = uasset.header["SavedByEngineVersion"]
                 compatible_with_version = uasset.header["CompatibleWithEngineVersion"]
-            except Exception as err:
-                logger.error(f"Failed to analyze {depot_path}: {err}")
-            results.append(
-                {
-                    "depot_path": f"{depot_path}@{changelist}",
-                    "uasset_type": uasset_type,
-                    "saved_by_version": saved_by_version,
-                    "compatible_with_version": compatible_with_version,
-                }
-            )
-    return results
+
+                if TRACK_DEPENDENCIES:
+                    try:
+                        dependencies = uasset.package_dependencies()
+                    except Exception as err:
+                        logger.error(f"Failed to read imports of {depot_path}: {err}")
+        except Exception as err:
+            logger.error(f"Failed to analyze {depot_path}: {err}")
+
+    return {
+        "depot_path": depot_path,
+        "uasset_type": uasset_type,
+        "saved_by_version": saved_by_version,
+        "compatible_with_version": compatible_with_version,
+        "dependencies": dependencies,
+    }
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("changelist")
+    parser.add_argument(
+        "--full-fetch",
+        action="store_true",
+        help="download each whole .uasset instead of only its header",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=ANALYZE_WORKERS,
+        help="number of processes parsing .uasset files",
+    )
+    parser.add_argument(
+        "--enqueue",
+        action="store_true",
+        help="queue the changelist for the worker service instead of running it now",
+    )
+    parser.add_argument("--priority", type=int, default=0, help="job priority when queued")
 
     parsed_args = parser.parse_args()
     if not parsed_args.changelist:
         parser.error("Please provide a changelist argument")
     cl = int(parsed_args.changelist)
-    main(cl)
+    if parsed_args.enqueue:
+        worker_service.enqueue(__file__, cl, parsed_args.priority)
+    else:
+        main(
+            cl,
+            partial=not parsed_args.full_fetch and PARTIAL_FETCH,
+            workers=parsed_args.workers,
+        )
@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import secrets
+import logging
+import argparse
+import threading
+import importlib
+import traceback
+import sqlite3
+import multiprocessing
+from pathlib import Path
+from multiprocessing.connection import Listener, Client, wait
+
+import job_queue
+import sqlite_store
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+SERVICE_HOST = os.environ.get("TRIGGER_SERVICE_HOST", "localhost")
+SERVICE_PORT = int(os.environ.get("TRIGGER_SERVICE_PORT", 6790))
+# Shared secret between the triggers and the service. Unless it's set here,
+# a random key is generated into AUTHKEY_PATH, readable only by the account
+# the triggers run as, the first time either side needs it.
+SERVICE_AUTHKEY = os.environ.get("TRIGGER_SERVICE_AUTHKEY", "")
+AUTHKEY_PATH = os.environ.get(
+    "TRIGGER_SERVICE_AUTHKEY_PATH", str(sqlite_store.DEFAULT_DIRECTORY / "trigger_service.key")
+)
+# Longest request the service reads; commands are a few bytes of JSON.
+MAX_MESSAGE_SIZE = 64 * 1024
+
+# Worker processes draining the job queue, i.e. changelists processed at once.
+SERVICE_WORKERS = int(os.environ.get("TRIGGER_SERVICE_WORKERS", 2))
+# Seconds an idle worker waits before checking the queue again.
+POLL_INTERVAL = float(os.environ.get("JOB_QUEUE_POLL_INTERVAL", 1))
+
+# Trigger script -> module whose main(changelist) the service runs for it.
+TRIGGERS = {
+    "main.py": "main",
+    "uasset_trigger.py": "uasset_trigger",
+}
+
+# Raised when the queue or the service can't take a job, e.g. another
+# program holds the service port and fails the handshake.
+UNAVAILABLE_ERRORS = (OSError, EOFError, multiprocessing.AuthenticationError, sqlite3.Error)
+
+
+def enqueue(script, changelist, priority=0, start=True, run_after=None):
+    """
+    Adds the changelist to the durable job queue for the trigger `script`,
+    then makes sure the service is running to pick it up. Returns the job id,
+    or None if the changelist was already queued.
+    """
+    queue = job_queue.from_environment()
+    job_id = queue.enqueue(TRIGGERS[Path(script).name], int(changelist), priority, run_after)
+    queue.close()
+
+    if start:
+        ensure_running()
+    return job_id
+
+
+def withdraw(job_id):
+    """
+    Takes a job back out of the queue unless a worker has claimed it.
+    Returns False if one has.
+    """
+    queue = job_queue.from_environment()
+    withdrawn = queue.withdraw(job_id)
+    queue.close()
+    return withdrawn
+
+
+def load_authkey(path=AUTHKEY_PATH):
+    """
+    Returns the key clients and the service authenticate each other with:
+    TRIGGER_SERVICE_AUTHKEY if set, otherwise the contents of `path`,
+    which is created with 32 random bytes and 0600 permissions if missing.
+    The key is written to a temporary file and linked into place, so a
+    trigger starting at the same time never reads a half-written key.
+    """
+    if SERVICE_AUTHKEY:
+        return SERVICE_AUTHKEY.encode("utf-8")
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if not path.exists():
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, "wb") as key_file:
+            key_file.write(secrets.token_hex(32).encode("ascii"))
+        try:
+            # Unlike a rename, linking fails if another process got there first.
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            temp_path.unlink()
+    elif path.stat().st_mode & 0o077:
+        logger.warning(f"{path} was readable by other users, restricting it to its owner")
+        os.chmod(path, 0o600)
+
+    authkey = path.read_bytes().strip()
+    if not authkey:
+        raise RuntimeError(f"Trigger service key file {path} is empty")
+    return authkey
+
+
+def send_message(connection, message):
+    connection.send_bytes(json.dumps(message).encode("utf-8"))
+
+
+def receive_message(connection):
+    # Messages are JSON rather than pickles, so a client can't make the
+    # service run code by what it sends.
+    return json.loads(connection.recv_bytes(MAX_MESSAGE_SIZE))
+
+
+def request(command, timeout=5):
+    """
+    Sends a command to the running service and returns its reply. Raises
+    OSError if no service is listening.
+    """
+    with Client((SERVICE_HOST, SERVICE_PORT), authkey=load_authkey()) as connection:
+        send_message(connection, {"command": command})
+        if not connection.poll(timeout):
+            raise TimeoutError("Trigger service did not reply")
+        return receive_message(connection)
+
+
+def ensure_running():
+    try:
+        request("ping")
+    except OSError:
+        import spawn_process
+
+        spawn_process.run_subprocess(str(Path(__file__)))
+
+
+def load_trigger(trigger, modules):
+    # P4 connections are made, and remade if dropped, by the trigger modules
+    # on first use, so a cached module is always safe to reuse.
+    if trigger not in modules:
+        modules[trigger] = importlib.import_module(trigger)
+    return modules[trigger]
+
+
+def work(name, stopping):
+    """
+    Worker process loop: claims jobs from the queue and runs them until
+    `stopping` is set. Trigger modules are imported once per worker, so their
+    P4 connections, Bedrock client and DAM settings stay warm between jobs.
+    """
+    queue = job_queue.from_environment()
+    modules = {}
+
+    while not stopping.is_set():
+        job = queue.claim(name)
+        if job is None:
+            stopping.wait(POLL_INTERVAL)
+            continue
+
+        logger.info(f"{name} running {job['trigger']} for changelist {job['changelist']}")
+        try:
+            load_trigger(job["trigger"], modules).main(job["changelist"])
+        except job_queue.DeferJob as deferral:
+            logger.info(f"Changelist {job['changelist']}: {deferral}")
+            queue.defer(job["id"], deferral.run_after)
+        except Exception:
+            logger.exception(f"{job['trigger']} failed for changelist {job['changelist']}")
+            queue.fail(job["id"], traceback.format_exc())
+        else:
+            queue.complete(job["id"])
+
+    queue.close()
+
+
+class WorkerService:
+    """
+    Long-lived process that owns the job queue's worker processes. Binding
+    the listener also makes it the only service on the machine, so jobs left
+    running by a previous service can safely be requeued on start. A worker
+    that dies mid-job (out of memory, a crash in the P4 API) has its job
+    failed and is replaced, so the job is retried and the service keeps its
+    full number of workers.
+    """
+
+    def __init__(self, workers=SERVICE_WORKERS, host=SERVICE_HOST, port=SERVICE_PORT, authkey=None):
+        self.workers = workers
+        self.address = (host, port)
+        self.authkey = authkey or load_authkey()
+        self.queue = job_queue.from_environment()
+        self.running = False
+        self.processes = {}
+
+        # Workers are spawned, not forked, and aren't daemonic so they can
+        # start their own parser processes.
+        self.context = multiprocessing.get_context("spawn")
+        self.stopping = self.context.Event()
+
+    def start_worker(self, name):
+        process = self.context.Process(target=work, args=(name, self.stopping), name=name)
+        process.start()
+        self.processes[name] = process
+
+    def supervise(self):
+        """
+        Waits on the worker processes until the service stops, replacing any
+        that exit in the meantime.
+        """
+        while not self.stopping.is_set():
+            sentinels = {process.sentinel: name for name, process in self.processes.items()}
+            for sentinel in wait(list(sentinels), timeout=POLL_INTERVAL):
+                if self.stopping.is_set():
+                    return
+                name = sentinels[sentinel]
+                self.processes[name].join()
+                exitcode = self.processes[name].exitcode
+                logger.error(f"{name} exited with code {exitcode}, starting a replacement")
+                self.queue.abandon(f"{name} exited with code {exitcode}", worker=name)
+                self.start_worker(name)
+
+    def serve_forever(self):
+        with Listener(self.address, authkey=self.authkey) as listener:
+            self.queue.recover()
+            self.queue.purge()
+
+            for index in range(self.workers):
+                self.start_worker(f"worker-{index}")
+            supervisor = threading.Thread(target=self.supervise, name="supervisor", daemon=True)
+            supervisor.start()
+
+            logger.info(f"Trigger service listening on {self.address} with {self.workers} workers")
+            self.running = True
+            while self.running:
+                try:
+                    with listener.accept() as connection:
+                        self.handle(connection)
+                except Exception as err:
+                    logger.error(f"Failed to handle request: {err}")
+
+            self.stopping.set()
+            supervisor.join()
+            for process in self.processes.values():
+                process.join()
+        self.queue.close()
+
+    def handle(self, connection):
+        message = receive_message(connection)
+        command = message.get("command") if isinstance(message, dict) else None
+        if command == "stop":
+            self.running = False
+            send_message(connection, {"status": "stopping"})
+        elif command == "ping":
+            send_message(connection, {"status": "running", "jobs": self.queue.counts()})
+        else:
+            send_message(connection, {"status": "rejected", "reason": f"unknown command {command}"})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stop", action="store_true", help="stop the running service")
+    parser.add_argument("--status", action="store_true", help="show job counts")
+    parser.add_argument("--workers", type=int, default=SERVICE_WORKERS)
+
+    parsed_args = parser.parse_args()
+    if parsed_args.stop or parsed_args.status:
+        print(request("stop" if parsed_args.stop else "ping"))
+        sys.exit()
+
+    sys.path.insert(0, str(Path(__file__).parent))
+    WorkerService(parsed_args.workers).serve_forever()
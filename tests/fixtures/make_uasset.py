@@ -0,0 +1,255 @@
+"""
+Writes small editor packages holding the same StaticMesh, which imports a
+material and a texture, soft references another mesh and has a PNG
+thumbnail. Export data is filler, as only the package header is parsed.
+
+SM_Chair.uasset is laid out as Unreal Engine 5.1 saves it (FileVersionUE4
+522, FileVersionUE5 1009). SM_Chair_4_11.uasset is laid out as Unreal Engine
+4.11 saves it (LegacyFileVersion -6, FileVersionUE4 498), which predates the
+name hashes, 64-bit export sizes, package names on imports and soft object
+paths.
+
+Run from this directory to regenerate the fixtures:
+    python make_uasset.py
+"""
+
+import struct
+from pathlib import Path
+
+FIXTURE_DIRECTORY = Path(__file__).resolve().parent
+
+VER_UE4_NAME_HASHES_SERIALIZED = 504
+VER_UE4_PRELOAD_DEPENDENCIES_IN_COOKED_EXPORTS = 507
+VER_UE4_TEMPLATE_INDEX_IN_COOKED_EXPORTS = 508
+VER_UE4_ADDED_SEARCHABLE_NAMES = 510
+VER_UE4_64BIT_EXPORTMAP_SERIALSIZES = 511
+VER_UE4_ADDED_SOFT_OBJECT_PATH = 514
+VER_UE4_ADDED_PACKAGE_SUMMARY_LOCALIZATION_ID = 516
+VER_UE4_ADDED_PACKAGE_OWNER = 518
+VER_UE4_NON_OUTER_PACKAGE_IMPORT = 520
+
+LAYOUTS = {
+    "SM_Chair.uasset": {
+        "LegacyFileVersion": -8,
+        "FileVersionUE4": 522,
+        "FileVersionUE5": 1009,
+        "SavedBy": (5, 1, 1, 23901901, "++UE5+Release-5.1"),
+        "CompatibleWith": (5, 1, 0, 23058290, "++UE5+Release-5.1"),
+        "CustomVersions": (
+            ("375EC13C06E448FBB50084F0262A717E", 4),  # FCoreObjectVersion
+            ("E4B068EDF49442E9A231DA0B2E46BB41", 40),  # FEditorObjectVersion
+            ("697DD581E64F41ABAA4A51ECBEB7B628", 65),  # FUE5MainStreamObjectVersion
+        ),
+    },
+    "SM_Chair_4_11.uasset": {
+        "LegacyFileVersion": -6,
+        "FileVersionUE4": 498,
+        "FileVersionUE5": 0,
+        "SavedBy": (4, 11, 2, 2987283, "++UE4+Release-4.11"),
+        "CompatibleWith": (4, 11, 0, 2921391, "++UE4+Release-4.11"),
+        "CustomVersions": (
+            ("E4B068EDF49442E9A231DA0B2E46BB41", 4),  # FEditorObjectVersion
+        ),
+    },
+}
+
+NAMES = (
+    "/Game/Materials/MI_Wood",
+    "/Game/Props/SM_Chair",
+    "/Game/Props/SM_Table",
+    "/Game/Textures/T_Wood",
+    "/Script/CoreUObject",
+    "/Script/Engine",
+    "Class",
+    "Default__StaticMesh",
+    "MaterialInstanceConstant",
+    "MI_Wood",
+    "None",
+    "Package",
+    "SM_Chair",
+    "StaticMesh",
+    "Texture2D",
+    "T_Wood",
+)
+# (class package, class name, outer index, object name, object name number,
+# package name). Names are indexes into NAMES.
+IMPORTS = (
+    (4, 11, 0, 5, 0, 10),  # -1 /Script/Engine
+    (4, 6, -1, 13, 0, 10),  # -2 StaticMesh class
+    (5, 13, -1, 7, 0, 10),  # -3 Default__StaticMesh
+    (4, 11, 0, 0, 0, 10),  # -4 /Game/Materials/MI_Wood
+    (5, 8, -4, 9, 0, 0),  # -5 MI_Wood
+    (4, 11, 0, 3, 0, 10),  # -6 /Game/Textures/T_Wood
+    (5, 14, -6, 15, 2, 3),  # -7 T_Wood_1, numbered to cover FName numbers
+)
+# (class index, super index, template index, outer index, object name)
+EXPORTS = ((-2, 0, -3, 0, 12),)
+DEPENDS = ((-5, -7),)
+SOFT_PACKAGE_REFERENCES = (2,)
+THUMBNAIL = b"\x89PNG\r\n\x1a\n" + bytes(range(56))
+
+
+def fstring(value):
+    if not value:
+        return struct.pack("<i", 0)
+    data = value.encode("utf-8") + b"\0"
+    return struct.pack("<i", len(data)) + data
+
+
+def guid(value):
+    # FGuid is four little endian uint32s.
+    return b"".join(
+        struct.pack("<I", int(value[start : start + 8], 16)) for start in range(0, 32, 8)
+    )
+
+
+def engine_version(major, minor, patch, changelist, branch):
+    return struct.pack("<HHHI", major, minor, patch, changelist) + fstring(branch)
+
+
+def build(layout):
+    ue4_version = layout["FileVersionUE4"]
+    out = bytearray()
+    offsets = {}
+
+    def pack(fmt, *values):
+        out.extend(struct.pack("<" + fmt, *values))
+
+    def placeholder(name, fmt="i"):
+        offsets[name] = (len(out), fmt)
+        pack(fmt, 0)
+
+    def fill(name, value):
+        position, fmt = offsets[name]
+        struct.pack_into("<" + fmt, out, position, value)
+
+    pack("I", 0x9E2A83C1)
+    pack("iii", layout["LegacyFileVersion"], 864, ue4_version)
+    if layout["LegacyFileVersion"] <= -8:
+        pack("i", layout["FileVersionUE5"])
+    pack("i", 0)  # FileVersionLicenseeUE4
+    pack("i", len(layout["CustomVersions"]))
+    for key, version in layout["CustomVersions"]:
+        out.extend(guid(key))
+        pack("i", version)
+    placeholder("TotalHeaderSize")
+    out.extend(fstring("/Game/Props/SM_Chair"))
+    pack("I", 0)  # PackageFlags
+    pack("i", len(NAMES))
+    placeholder("NameOffset")
+    if layout["FileVersionUE5"]:
+        pack("II", 0, 0)  # SoftObjectPaths
+    if ue4_version >= VER_UE4_ADDED_PACKAGE_SUMMARY_LOCALIZATION_ID:
+        out.extend(fstring(""))  # LocalizationId
+    pack("ii", 0, 0)  # GatherableTextData
+    pack("i", len(EXPORTS))
+    placeholder("ExportOffset")
+    pack("i", len(IMPORTS))
+    placeholder("ImportOffset")
+    placeholder("DependsOffset")
+    pack("i", len(SOFT_PACKAGE_REFERENCES))
+    placeholder("SoftPackageReferencesOffset")
+    if ue4_version >= VER_UE4_ADDED_SEARCHABLE_NAMES:
+        pack("i", 0)  # SearchableNamesOffset
+    placeholder("ThumbnailTableOffset")
+    out.extend(guid("8C1F3A2B4D5E6F708192A3B4C5D6E7F8"))  # Guid
+    if ue4_version >= VER_UE4_ADDED_PACKAGE_OWNER:
+        out.extend(guid("0F1E2D3C4B5A69788796A5B4C3D2E1F0"))  # PersistentGuid
+    pack("iii", 1, len(EXPORTS), len(NAMES))  # Generations
+    out.extend(engine_version(*layout["SavedBy"]))
+    out.extend(engine_version(*layout["CompatibleWith"]))
+    pack("Iii", 0, 0, 0)  # CompressionFlags, CompressedChunks, PackageSource
+    pack("i", 0)  # AdditionalPackagesToCook
+    if layout["LegacyFileVersion"] > -7:
+        pack("i", 0)  # NumTextureAllocations
+    placeholder("AssetRegistryDataOffset")
+    placeholder("BulkDataStartOffset", "q")
+    pack("i", 0)  # WorldTileInfoDataOffset
+    pack("i", 0)  # ChunkIDs
+    if ue4_version >= VER_UE4_PRELOAD_DEPENDENCIES_IN_COOKED_EXPORTS:
+        pack("ii", 0, 0)  # PreloadDependencyCount, PreloadDependencyOffset
+    if layout["FileVersionUE5"]:
+        pack("i", len(NAMES))  # NamesReferencedFromExportDataCount
+        pack("q", -1)  # PayloadTocOffset
+        pack("i", -1)  # DataResourceOffset
+
+    fill("NameOffset", len(out))
+    for name in NAMES:
+        out.extend(fstring(name))
+        if ue4_version >= VER_UE4_NAME_HASHES_SERIALIZED:
+            pack("HH", 0, 0)  # name hashes, not read
+
+    fill("ImportOffset", len(out))
+    for class_package, class_name, outer, object_name, number, package_name in IMPORTS:
+        pack("ii", class_package, 0)
+        pack("ii", class_name, 0)
+        pack("i", outer)
+        pack("ii", object_name, number)
+        if ue4_version >= VER_UE4_NON_OUTER_PACKAGE_IMPORT:
+            pack("ii", package_name, 0)
+        if layout["FileVersionUE5"]:
+            pack("i", 0)  # bImportOptional
+
+    fill("ExportOffset", len(out))
+    export_offsets = []
+    serial_format = "qq" if ue4_version >= VER_UE4_64BIT_EXPORTMAP_SERIALSIZES else "ii"
+    for class_index, super_index, template_index, outer, object_name in EXPORTS:
+        pack("ii", class_index, super_index)
+        if ue4_version >= VER_UE4_TEMPLATE_INDEX_IN_COOKED_EXPORTS:
+            pack("i", template_index)
+        pack("i", outer)
+        pack("ii", object_name, 0)
+        pack("I", 0x00000001)  # RF_Public
+        export_offsets.append(len(out))
+        pack(serial_format, 0, 0)  # SerialSize, SerialOffset
+        pack("iii", 0, 0, 0)  # bForcedExport, bNotForClient, bNotForServer
+        if layout["FileVersionUE5"]:
+            pack("i", 0)  # bIsInheritedInstance
+        else:
+            out.extend(bytes(16))  # PackageGuid
+        pack("I", 0)  # PackageFlags
+        pack("ii", 0, 1)  # bNotAlwaysLoadedForEditorGame, bIsAsset
+        if layout["FileVersionUE5"]:
+            pack("i", 0)  # bGeneratePublicHash
+        if ue4_version >= VER_UE4_PRELOAD_DEPENDENCIES_IN_COOKED_EXPORTS:
+            pack("iiiii", -1, 0, 0, 0, 0)
+
+    fill("DependsOffset", len(out))
+    for dependencies in DEPENDS:
+        pack("i", len(dependencies))
+        for dependency in dependencies:
+            pack("i", dependency)
+
+    fill("SoftPackageReferencesOffset", len(out))
+    for name in SOFT_PACKAGE_REFERENCES:
+        if ue4_version >= VER_UE4_ADDED_SOFT_OBJECT_PATH:
+            pack("ii", name, 0)
+        else:
+            out.extend(fstring(NAMES[name]))
+
+    thumbnail_offset = len(out)
+    pack("iii", 64, 64, len(THUMBNAIL))
+    out.extend(THUMBNAIL)
+
+    fill("ThumbnailTableOffset", len(out))
+    pack("i", 1)
+    out.extend(fstring("StaticMesh"))
+    out.extend(fstring("SM_Chair"))
+    pack("i", thumbnail_offset)
+
+    fill("AssetRegistryDataOffset", len(out))
+    pack("ii", 0, 0)  # dependency data offset, asset count
+
+    fill("TotalHeaderSize", len(out))
+    export_data = b"\0" * 256
+    for position in export_offsets:
+        struct.pack_into("<" + serial_format, out, position, len(export_data), len(out))
+    out.extend(export_data)
+    fill("BulkDataStartOffset", len(out))
+
+    return bytes(out)
+
+
+if __name__ == "__main__":
+    for file_name, layout in LAYOUTS.items():
+        (FIXTURE_DIRECTORY / file_name).write_bytes(build(layout))
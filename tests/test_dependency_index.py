@@ -0,0 +1,35 @@
+from uasset_analyzer.dependency_index import DependencyIndex, package_from_depot_path
+
+MAIN = "//proj/main/Game"
+DEV = "//proj/dev/Game"
+
+
+def test_package_from_depot_path():
+    assert package_from_depot_path("//proj/main/Game/Content/Textures/T_Brick.uasset@12") == (
+        MAIN,
+        "/Game/Textures/T_Brick",
+    )
+    assert package_from_depot_path("//proj/main/Game/Plugins/Foo/Content/Bar.uasset") == (
+        MAIN,
+        "/Foo/Bar",
+    )
+    assert package_from_depot_path("//proj/main/Game/Config/DefaultGame.ini") is None
+
+
+def test_branches_are_kept_apart(tmp_path):
+    index = DependencyIndex(tmp_path / "index.sqlite3")
+    index.update_package(MAIN, "/Game/SM_Chair", f"{MAIN}/Content/SM_Chair.uasset", ["/Game/T_Wood"])
+    index.update_package(MAIN, "/Game/SM_Table", f"{MAIN}/Content/SM_Table.uasset", ["/Game/T_Wood"])
+    index.update_package(DEV, "/Game/SM_Chair", f"{DEV}/Content/SM_Chair.uasset", ["/Game/T_Wood"])
+    index.update_package(DEV, "/Game/T_Wood", f"{DEV}/Content/T_Wood.uasset", [])
+
+    assert index.referencer_count(MAIN, "/Game/T_Wood") == 2
+    assert index.referencer_count(DEV, "/game/t_wood") == 1
+    assert index.depot_path(MAIN, "/Game/SM_Chair") == f"{MAIN}/Content/SM_Chair.uasset"
+    assert index.depot_path(MAIN, "/Game/T_Wood") is None
+    assert index.transitive_referencers(DEV, "/Game/T_Wood") == ["/Game/SM_Chair"]
+
+    assert index.remove_package(MAIN, "/Game/SM_Table") == ["/Game/T_Wood"]
+    assert index.referencer_count(MAIN, "/Game/T_Wood") == 1
+    assert index.referencer_count(DEV, "/Game/T_Wood") == 1
+    index.close()
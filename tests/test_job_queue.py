@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+import job_queue
+from job_queue import JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite3", max_attempts=2, retry_delay=0)
+    yield queue
+    queue.close()
+
+
+def status(queue, job_id):
+    return queue.connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+
+def test_claims_by_priority_then_age(queue):
+    first = queue.enqueue("main", 1)
+    second = queue.enqueue("main", 2)
+    urgent = queue.enqueue("uasset_trigger", 3, priority=5)
+
+    assert [queue.claim("worker-0")["id"] for _ in range(3)] == [urgent, first, second]
+    assert queue.claim("worker-0") is None
+
+
+def test_duplicate_enqueue_raises_priority(queue):
+    job_id = queue.enqueue("main", 1)
+    queue.enqueue("main", 2, priority=1)
+
+    assert queue.enqueue("main", 1, priority=3) is None
+    assert queue.claim("worker-0")["id"] == job_id
+    # Running jobs aren't queued again either, but other triggers are.
+    assert queue.enqueue("main", 1) is None
+    assert queue.enqueue("uasset_trigger", 1) is not None
+
+
+def test_failed_jobs_retry_until_out_of_attempts(queue):
+    job_id = queue.enqueue("main", 1)
+
+    queue.claim("worker-0")
+    queue.fail(job_id, "boom")
+    assert status(queue, job_id)["status"] == job_queue.PENDING
+
+    assert queue.claim("worker-0")["attempts"] == 2
+    queue.fail(job_id, "boom again")
+    assert status(queue, job_id)["status"] == job_queue.FAILED
+    assert queue.claim("worker-0") is None
+
+
+def test_deferred_jobs_keep_their_attempts(queue):
+    job_id = queue.enqueue("main", 1)
+    queue.claim("worker-0")
+    queue.defer(job_id, time.time() + 3600)
+
+    row = status(queue, job_id)
+    assert (row["status"], row["attempts"]) == (job_queue.PENDING, 0)
+    assert queue.claim("worker-0") is None
+
+
+def test_abandon_and_recover_count_the_attempt(queue):
+    crashed = queue.enqueue("main", 1)
+    healthy = queue.enqueue("main", 2)
+    queue.claim("worker-0")
+    queue.claim("worker-1")
+
+    assert queue.abandon("worker-0 exited", worker="worker-0") == 1
+    assert status(queue, crashed)["status"] == job_queue.PENDING
+    assert status(queue, healthy)["status"] == job_queue.RUNNING
+
+    queue.claim("worker-0")
+    assert queue.recover() == 2
+    assert status(queue, crashed)["status"] == job_queue.FAILED
+    assert status(queue, healthy)["status"] == job_queue.PENDING
+    assert status(queue, healthy)["attempts"] == 1
+
+
+def test_withdraw_only_unclaimed_jobs(queue):
+    claimed = queue.enqueue("main", 1)
+    waiting = queue.enqueue("main", 2)
+    queue.claim("worker-0")
+
+    assert not queue.withdraw(claimed)
+    assert queue.withdraw(waiting)
+    assert queue.counts() == {job_queue.RUNNING: 1}
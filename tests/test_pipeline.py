@@ -0,0 +1,73 @@
+import threading
+import time
+
+import pytest
+
+from pipeline import Stage, run_pipeline
+
+
+def test_stages_drop_none_and_failed_items():
+    def check(item):
+        if item == 3:
+            raise ValueError("bad item")
+        return item
+
+    results = run_pipeline(
+        range(6),
+        [
+            Stage("check", check, workers=2),
+            Stage("odd", lambda item: item if item % 2 else None),
+        ],
+    )
+    assert sorted(results) == [1, 5]
+
+
+def test_batching_stage_gets_lists():
+    batches = []
+
+    def describe(items):
+        batches.append(list(items))
+        return [item * 10 for item in items]
+
+    results = run_pipeline(range(7), [Stage("describe", describe, batch_size=3, batch_wait=0.5)])
+    assert sorted(results) == [item * 10 for item in range(7)]
+    assert all(1 <= len(batch) <= 3 for batch in batches)
+    assert sorted(item for batch in batches for item in batch) == list(range(7))
+
+
+def test_slow_stage_holds_back_the_source():
+    produced = []
+    release = threading.Event()
+
+    def source():
+        for item in range(100):
+            produced.append(item)
+            yield item
+
+    def slow(item):
+        release.wait()
+        return item
+
+    thread = threading.Thread(
+        target=lambda: run_pipeline(source(), [Stage("slow", slow)], queue_size=2)
+    )
+    thread.start()
+    time.sleep(0.3)
+    # Two queued, one in the stage and one waiting to be queued by the source.
+    assert len(produced) <= 4
+    release.set()
+    thread.join(5)
+    assert len(produced) == 100
+
+
+def test_source_error_is_raised_after_fetched_items_finish():
+    written = []
+
+    def source():
+        yield 1
+        yield 2
+        raise ConnectionError("p4 went away")
+
+    with pytest.raises(ConnectionError):
+        run_pipeline(source(), [Stage("write", written.append)])
+    assert sorted(written) == [1, 2]
@@ -0,0 +1,95 @@
+from pathlib import Path
+
+import pytest
+
+from uasset_analyzer import UassetReader, read_total_header_size
+
+FIXTURE_PATH = Path(__file__).resolve().parent / "fixtures" / "SM_Chair.uasset"
+UE4_11_FIXTURE_PATH = FIXTURE_PATH.with_name("SM_Chair_4_11.uasset")
+
+
+@pytest.fixture(params=["mmap", "file", "bytes"])
+def uasset(request):
+    if request.param == "bytes":
+        reader = UassetReader(FIXTURE_PATH.read_bytes())
+    else:
+        reader = UassetReader(FIXTURE_PATH, use_mmap=request.param == "mmap")
+    yield reader
+    reader.close()
+
+
+def test_header_versions(uasset):
+    assert uasset.header["FileVersionUE4"] == 522
+    assert uasset.header["FileVersionUE5"] == 1009
+    assert uasset.header["SavedByEngineVersion"] == "5.1.1-23901901+++UE5+Release-5.1"
+    assert uasset.header["CompatibleWithEngineVersion"] == "5.1.0-23058290+++UE5+Release-5.1"
+
+
+def test_thumbnail_table(uasset):
+    assert uasset.thumbnail_table[0]["AssetClassName"] == "StaticMesh"
+    assert uasset.thumbnail_table[0]["ObjectPathWithoutPackageName"] == "SM_Chair"
+
+    thumbnail = uasset.thumbnails[0]
+    assert thumbnail["Format"] == "PNG"
+    assert bytes(thumbnail["Bytes"]).startswith(b"\x89PNG")
+
+
+def test_package_dependencies(uasset):
+    assert uasset.package_dependencies() == [
+        "/Script/Engine",
+        "/Game/Materials/MI_Wood",
+        "/Game/Textures/T_Wood",
+        "/Game/Props/SM_Table",
+    ]
+
+
+def test_imports_resolve_numbered_names(uasset):
+    texture = uasset.imports[-1]
+    assert texture["ClassName"] == "Texture2D"
+    assert texture["ObjectName"] == "T_Wood_1"
+    assert texture["PackageName"] == "/Game/Textures/T_Wood"
+    # Negative package indexes refer to import -index - 1.
+    assert uasset.imports[-texture["OuterIndex"] - 1]["ObjectName"] == "/Game/Textures/T_Wood"
+
+
+def test_exports(uasset):
+    assert len(uasset.exports) == 1
+    export = uasset.exports[0]
+    assert export["ObjectName"] == "SM_Chair"
+    assert uasset.imports[-export["ClassIndex"] - 1]["ObjectName"] == "StaticMesh"
+    assert export["bIsAsset"] == 1
+    assert export["SerialOffset"] == uasset.header["TotalHeaderSize"]
+    assert list(uasset.dependencies) == [[-5, -7]]
+
+
+def test_header_only_buffer():
+    data = FIXTURE_PATH.read_bytes()
+    header_size = read_total_header_size(data)
+    assert read_total_header_size(data[:64]) is None
+
+    with UassetReader(data[:header_size]) as uasset:
+        assert uasset.thumbnail_table[0]["AssetClassName"] == "StaticMesh"
+        assert "/Game/Textures/T_Wood" in uasset.package_dependencies()
+
+
+def test_ue4_11_package():
+    # Saved before name hashes, package names on imports and soft object
+    # paths were serialized, so every table sits at a different offset.
+    with UassetReader(UE4_11_FIXTURE_PATH) as uasset:
+        assert uasset.header["FileVersionUE4"] == 498
+        assert uasset.header["SavedByEngineVersion"] == "4.11.2-2987283+++UE4+Release-4.11"
+        assert uasset.names[0] == "/Game/Materials/MI_Wood"
+        assert uasset.names[len(uasset.names) - 1] == "T_Wood"
+        assert list(uasset.names.case_preserving_hashes) == [0] * len(uasset.names)
+
+        assert uasset.imports[-1]["ObjectName"] == "T_Wood_1"
+        assert uasset.exports[0]["ObjectName"] == "SM_Chair"
+        assert uasset.exports[0]["SerialOffset"] == uasset.header["TotalHeaderSize"]
+        assert list(uasset.dependencies) == [[-5, -7]]
+        assert uasset.package_dependencies() == [
+            "/Script/Engine",
+            "/Game/Materials/MI_Wood",
+            "/Game/Textures/T_Wood",
+            "/Game/Props/SM_Table",
+        ]
+        assert uasset.thumbnail_table[0]["AssetClassName"] == "StaticMesh"
@@ -0,0 +1,105 @@
+import os
+import pickle
+import socket
+import stat
+import threading
+import time
+from multiprocessing import Pipe
+
+import pytest
+
+import job_queue
+import worker_service
+
+TRIGGERS = {
+    "crashing_trigger": "import os\n\ndef main(changelist):\n    os._exit(3)\n",
+    "passing_trigger": "def main(changelist):\n    pass\n",
+}
+
+
+def test_authkey_file_is_created_private_and_reused(tmp_path, monkeypatch):
+    monkeypatch.setattr(worker_service, "SERVICE_AUTHKEY", "")
+    path = tmp_path / "service" / "trigger_service.key"
+
+    authkey = worker_service.load_authkey(path)
+    assert len(authkey) == 64
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+    assert worker_service.load_authkey(path) == authkey
+
+    os.chmod(path, 0o644)
+    assert worker_service.load_authkey(path) == authkey
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+
+
+def test_messages_are_json_only():
+    reader, writer = Pipe()
+    worker_service.send_message(writer, {"command": "ping"})
+    assert worker_service.receive_message(reader) == {"command": "ping"}
+
+    writer.send_bytes(pickle.dumps({"command": "ping"}))
+    with pytest.raises(ValueError):
+        worker_service.receive_message(reader)
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("localhost", 0))
+        return probe.getsockname()[1]
+
+
+def wait_for(condition, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.1)
+
+
+def test_dead_worker_is_replaced_and_its_job_gives_up(tmp_path, monkeypatch):
+    for name, source in TRIGGERS.items():
+        (tmp_path / f"{name}.py").write_text(source)
+    # Spawned workers start from this process's sys.path and environment.
+    monkeypatch.syspath_prepend(str(tmp_path))
+    queue_path = str(tmp_path / "jobs.sqlite3")
+    monkeypatch.setenv("JOB_QUEUE_PATH", queue_path)
+    monkeypatch.setenv("JOB_QUEUE_MAX_ATTEMPTS", "2")
+    monkeypatch.setenv("JOB_QUEUE_RETRY_DELAY", "0")
+    monkeypatch.setenv("JOB_QUEUE_POLL_INTERVAL", "0.1")
+    monkeypatch.setattr(
+        job_queue,
+        "from_environment",
+        lambda: job_queue.JobQueue(queue_path, max_attempts=2, retry_delay=0),
+    )
+    monkeypatch.setattr(worker_service, "POLL_INTERVAL", 0.1)
+    monkeypatch.setattr(worker_service, "SERVICE_PORT", free_port())
+    monkeypatch.setattr(worker_service, "SERVICE_AUTHKEY", "test-key")
+
+    queue = job_queue.from_environment()
+    crashing = queue.enqueue("crashing_trigger", 1)
+    service = worker_service.WorkerService(workers=1, port=worker_service.SERVICE_PORT)
+    thread = threading.Thread(target=service.serve_forever, daemon=True)
+    thread.start()
+    try:
+        wait_for(lambda: queue.counts().get(job_queue.FAILED) == 1)
+        # The replacement worker still picks up new jobs.
+        passing = queue.enqueue("passing_trigger", 2)
+        wait_for(lambda: queue.counts().get(job_queue.DONE) == 1)
+    finally:
+        wait_for(_stop_service)
+        thread.join(30)
+
+    attempts = queue.connection.execute(
+        "SELECT id, attempts, status FROM jobs ORDER BY id"
+    ).fetchall()
+    queue.close()
+    assert [tuple(row) for row in attempts] == [
+        (crashing, 2, job_queue.FAILED),
+        (passing, 1, job_queue.DONE),
+    ]
+    assert not thread.is_alive()
+
+
+def _stop_service():
+    try:
+        return worker_service.request("stop")["status"] == "stopping"
+    except OSError:
+        return False